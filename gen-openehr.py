@@ -4,17 +4,33 @@ openEHR Synthetic Data Generator
 """
 
 import os
+import pickle
+import re
 import json
-import copy
+import math
+import bisect
+import collections
+import functools
+import shutil
+import statistics
+import threading
+import zlib
+import gzip
+import hashlib
+import heapq
+import importlib.util
 import datetime as dt
 import xml.etree.ElementTree as ET
 import random
 import asyncio
 import urllib.parse
+from array import array
 import tarfile
 import io
 import time
+import tracemalloc
 import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 
@@ -25,12 +41,42 @@ OPT_DIR        = os.path.join(BASE, "opts")
 WT_DIR         = os.path.join(BASE, "opt_webtemplates")
 USER_COMPS_DIR = os.path.join(BASE, "user_compositions")
 FLAT_DIR       = os.path.join(BASE, "flat_composition_skeletons")
+CORPUS_DIR     = os.path.join(BASE, "text_corpus")
+CORPUS_CACHE   = os.path.join(CORPUS_DIR, ".model.pickle")
+HANDLERS_DIR   = os.path.join(BASE, "rm_handlers")
 DIST_DIR       = os.path.join("dist", "compositions")
 CONFIG_FILE    = "ehrbase_config.json"
+SETUP_MANIFEST = os.path.join(BASE, "setup_manifest.json")
+BENCH_REPORT   = os.path.join("dist", "aql_benchmark.json")
+PROFILE_DIR    = os.path.join("dist", "mutation_profile")
+WORKLOAD_FILE  = os.path.join(BASE, "workload.json")
 
 _AQL_PAGE: int = 10  # compositions per paginated AQL query
-
-for d in (OPT_DIR, WT_DIR, USER_COMPS_DIR, FLAT_DIR, DIST_DIR):
+_CONTRIBUTION_BATCH: int = 25  # default compositions per contribution (1 = off)
+_CONTRIBUTION_MAX_FAILURES: int = 3  # consecutive rejected batches before contributions are dropped
+_GZIP_LEVEL: int = 5  # request body compression level (remote CDRs)
+_GZIP_MIN_BYTES: int = 1024  # smaller bodies are sent uncompressed
+_FANOUT: int = 256  # subdirectories per level for individual-file output
+_WRITERS: int = 4  # parallel writer threads for individual-file output
+_PROFILE_SUFFIX: str = ".profile.json"  # per-template value distributions, next to the WT
+_TEXT_WORDS: tuple[int, int] = (4, 24)  # default (min, max) words for free-text DV_TEXT
+_BLOOM_MAX_BYTES: int = 64 * 2**20  # memory cap for the uniqueness filter
+_UNIQUE_RETRIES: int = 5  # regenerations per duplicate before it is emitted anyway
+_PLAN_SAMPLES: int = 200  # compositions generated per skeleton by the planner
+_PLAN_PROBES: int = 3  # real CDR posts per skeleton when the planner probes
+_PROFILE_TRACED: int = 20  # compositions per skeleton in the profiler's tracemalloc pass
+_EHR_RUN: int = 20  # consecutive compositions a writer sends to one EHR
+_GENERATE_WORKERS: int = 10  # concurrent Mode 2 writers (one CDR request in flight each)
+_MUTATE_BATCH: int = 32  # compositions mutated per batch for fixed-shape skeletons
+_TREND_SLOPE_SD: float = 0.005  # sd of a DV_QUANTITY's relative drift per composition
+_TREND_NOISE: float = 0.03  # relative noise around a DV_QUANTITY trend
+_BENCH_REPEATS: int = 20  # timed runs per benchmark query
+_BENCH_WARMUP: int = 3  # untimed runs per benchmark query
+_BENCH_ROW_LIMIT: int = 1000  # LIMIT on benchmark queries (0 = none)
+_BENCH_COLUMNS: int = 8  # leaf values projected per archetype
+_BENCH_PER_ARCHETYPE: int = 2  # range / coded-text queries per archetype
+
+for d in (OPT_DIR, WT_DIR, USER_COMPS_DIR, FLAT_DIR, CORPUS_DIR, HANDLERS_DIR, DIST_DIR):
     os.makedirs(d, exist_ok=True)
 
 
@@ -69,6 +115,266 @@ def wt_path_of(flat_key: str) -> str:
     return "/".join(parts)
 
 
+# ── free-text model ────────────────────────────────────────────────────────────
+
+_BOS, _EOS = 0, 1  # sentence start / end token ids
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+_NO_SPACE_BEFORE = frozenset(".,;:!?%)]}")
+
+
+def _tokenizer():
+    try:
+        from nltk.tokenize import wordpunct_tokenize
+        return wordpunct_tokenize
+    except ImportError:
+        return re.compile(r"\w+|[^\w\s]+").findall
+
+
+def _corpus_files() -> list[str]:
+    return sorted(
+        os.path.join(CORPUS_DIR, f) for f in os.listdir(CORPUS_DIR) if f.endswith(".txt")
+    )
+
+
+def _corpus_digest(files: list[str]) -> str:
+    h = hashlib.sha256()
+    for path in files:
+        h.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class TextModel:
+    """
+    First-order Markov chain over corpus tokens, stored as CSR arrays:
+    successors of token t are nexts[offsets[t]:offsets[t + 1]] with running
+    counts in cum[...] — a draw is one random() and a bisect.
+    """
+
+    def __init__(self, vocab: list[str], offsets: array, nexts: array, cum: array) -> None:
+        self.vocab = vocab
+        self.offsets = offsets
+        self.nexts = nexts
+        self.cum = cum
+        self.glue = [bool(tok) and tok[0] in _NO_SPACE_BEFORE for tok in vocab]
+
+    @classmethod
+    def build(cls, files: list[str]) -> "TextModel":
+        tokenize = _tokenizer()
+        ids: dict[str, int] = {"<s>": _BOS, "</s>": _EOS}
+        counts: dict[int, dict[int, int]] = {}
+        for path in files:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            for sentence in _SENTENCE_END.split(text):
+                tokens = tokenize(sentence)
+                if len(tokens) < 3:
+                    continue
+                prev = _BOS
+                for tok in tokens:
+                    tid = ids.setdefault(tok, len(ids))
+                    row = counts.setdefault(prev, {})
+                    row[tid] = row.get(tid, 0) + 1
+                    prev = tid
+                row = counts.setdefault(prev, {})
+                row[_EOS] = row.get(_EOS, 0) + 1
+        offsets, nexts, cum = array("I", [0]), array("I"), array("I")
+        for tid in range(len(ids)):
+            running = 0
+            for nxt, n in sorted((counts.get(tid) or {}).items()):
+                running += n
+                nexts.append(nxt)
+                cum.append(running)
+            offsets.append(len(nexts))
+        vocab = [""] * len(ids)
+        for tok, tid in ids.items():
+            vocab[tid] = tok
+        return cls(vocab, offsets, nexts, cum)
+
+    def _next(self, tid: int) -> int:
+        lo, hi = self.offsets[tid], self.offsets[tid + 1]
+        if lo == hi:
+            return _EOS
+        r = random.random() * self.cum[hi - 1]
+        return self.nexts[bisect.bisect_right(self.cum, r, lo, hi)]
+
+    def text(self, min_words: int, max_words: int) -> str:
+        """Whole sentences until min_words is reached, cut at max_words."""
+        vocab, glue = self.vocab, self.glue
+        parts: list[str] = []
+        words = 0
+        while words < min_words:
+            tid = self._next(_BOS)
+            while tid != _EOS and words < max_words:
+                if glue[tid] and parts:
+                    parts[-1] += vocab[tid]
+                else:
+                    parts.append(vocab[tid])
+                    words += 1
+                tid = self._next(tid)
+            if words >= max_words or len(vocab) <= 2:
+                break
+        return " ".join(parts)
+
+
+@functools.lru_cache(maxsize=1)
+def text_model() -> Optional[TextModel]:
+    """
+    Free-text model built from CORPUS_DIR/*.txt, cached in CORPUS_CACHE and
+    rebuilt only when the corpus content changes. None without a corpus.
+    """
+    files = _corpus_files()
+    if not files:
+        return None
+    digest = _corpus_digest(files)
+    if os.path.exists(CORPUS_CACHE):
+        try:
+            with open(CORPUS_CACHE, "rb") as f:
+                cached = pickle.load(f)
+            if cached.get("sha256") == digest:
+                return TextModel(cached["vocab"], cached["offsets"], cached["nexts"], cached["cum"])
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+            pass
+    print(f"[*] Building free-text model from {len(files)} corpus file(s) ...")
+    model = TextModel.build(files)
+    with open(CORPUS_CACHE, "wb") as f:
+        pickle.dump(
+            {"sha256": digest, "vocab": model.vocab, "offsets": model.offsets,
+             "nexts": model.nexts, "cum": model.cum},
+            f, protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    return model
+
+
+# ── value distribution profiles ────────────────────────────────────────────────
+
+class AliasSampler:
+    """Walker/Vose alias table: O(k) to build, O(1) per draw."""
+
+    def __init__(self, items: list, weights: list[float]) -> None:
+        n = len(items)
+        total = float(sum(weights))
+        if n == 0 or total <= 0:
+            raise ValueError("AliasSampler needs at least one positive weight")
+        scaled = [w * n / total for w in weights]
+        self.items = items
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        self.n = n
+
+    def pick(self):
+        u = random.random() * self.n
+        i = int(u)
+        return self.items[i] if u - i < self.prob[i] else self.items[self.alias[i]]
+
+
+def _profile_list(wt_node: dict) -> list[dict]:
+    """The WT value list mutate_flat picks from for this node, if any."""
+    inputs = wt_node.get("inputs") or []
+    rm_type = wt_node.get("rmType", "")
+    if rm_type == "DV_CODED_TEXT":
+        inp = next((i for i in inputs if i.get("suffix") == "code" and i.get("list")), None)
+    elif rm_type == "DV_ORDINAL":
+        inp = next((i for i in inputs if i.get("type") == "CODED_TEXT" and i.get("list")), None)
+    elif rm_type == "DV_TEXT":
+        inp = next((i for i in inputs if i.get("type") == "TEXT"), None)
+    else:
+        inp = None
+    return (inp.get("list") or []) if inp else []
+
+
+def _numeric_draw(spec: dict):
+    """Zero-arg sampler for a numeric distribution spec, or None."""
+    if "normal" in spec:
+        p = spec["normal"]
+        return functools.partial(random.gauss, float(p["mean"]), float(p["sd"]))
+    if "lognormal" in spec:
+        p = spec["lognormal"]
+        return functools.partial(random.lognormvariate, float(p["mu"]), float(p["sigma"]))
+    if "uniform" in spec:
+        p = spec["uniform"]
+        return functools.partial(random.uniform, float(p["min"]), float(p["max"]))
+    if "triangular" in spec:
+        p = spec["triangular"]
+        return functools.partial(
+            random.triangular, float(p["min"]), float(p["max"]), float(p["mode"])
+        )
+    return None
+
+
+def compile_profile(raw: dict, wt_index: dict[str, dict]) -> dict[str, object]:
+    """
+    Compile a distribution profile into {WT id-path: zero-arg sampler}.
+
+      {"<wt id-path>": {"weights": {"<code or label>": w, "*": w_default}}}
+          coded text, ordinal, constrained text — sampler returns a WT list entry
+      {"<wt id-path>": {"normal": {"mean": m, "sd": s}}}     (also lognormal,
+          uniform, triangular) quantity magnitude, count, duration (seconds),
+          proportion numerator — sampler returns a number
+      {"<wt id-path>": {"text": {"min_words": a, "max_words": b}}}
+          free-text DV_TEXT from the corpus model — sampler returns a string
+    """
+    compiled: dict[str, object] = {}
+    for wt_path, spec in raw.items():
+        wt_node = wt_index.get(wt_path)
+        if wt_node is None or not isinstance(spec, dict):
+            print(f"  [~] Profile: no WT node {wt_path!r} — ignored")
+            continue
+        rm_type = wt_node.get("rmType", "")
+        if "text" in spec:
+            model = text_model()
+            if rm_type != "DV_TEXT" or model is None:
+                print(f"  [~] Profile: text spec needs a DV_TEXT node and a corpus in {CORPUS_DIR} — {wt_path!r} ignored")
+                continue
+            p = spec["text"]
+            lo = int(p.get("min_words", _TEXT_WORDS[0]))
+            compiled[wt_path] = functools.partial(
+                model.text, lo, max(lo, int(p.get("max_words", _TEXT_WORDS[1])))
+            )
+            continue
+        if "weights" in spec:
+            entries = _profile_list(wt_node)
+            weights = spec["weights"]
+            default = float(weights.get("*", 0))
+            w = [
+                float(weights.get(e["value"], weights.get(e.get("label", ""), default)))
+                for e in entries
+            ]
+            try:
+                compiled[wt_path] = AliasSampler(entries, w).pick
+            except ValueError:
+                print(f"  [~] Profile: no positive weight matches the WT list of {wt_path!r} — ignored")
+            continue
+        if rm_type not in ("DV_QUANTITY", "DV_COUNT", "DV_DURATION", "DV_PROPORTION"):
+            print(f"  [~] Profile: numeric distribution on {rm_type} node {wt_path!r} — ignored")
+            continue
+        draw = _numeric_draw(spec)
+        if draw is None:
+            print(f"  [~] Profile: unknown distribution for {wt_path!r} — ignored")
+            continue
+        compiled[wt_path] = draw
+    return compiled
+
+
+def load_profile(template_id: str, wt_index: dict[str, dict]) -> dict[str, object]:
+    """Compiled profile from <WT_DIR>/<template_id>.profile.json, {} if absent."""
+    path = os.path.join(WT_DIR, f"{template_id}{_PROFILE_SUFFIX}")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return compile_profile(json.load(f), wt_index)
+
+
 # ── mutation ───────────────────────────────────────────────────────────────────
 
 _PROTECTED_SEGMENTS = frozenset({
@@ -115,196 +421,808 @@ def _jitter_datetime(value: str, rm_type: str) -> str:
     return value  # unchanged if parsing failed
 
 
-def mutate_flat(flat: dict, wt_index: dict[str, dict]) -> dict:
+_DURATION = re.compile(
+    r"^(-)?P(?:([\d.]+)Y)?(?:([\d.]+)M)?(?:([\d.]+)W)?(?:([\d.]+)D)?"
+    r"(?:T(?:([\d.]+)H)?(?:([\d.]+)M)?(?:([\d.]+)S)?)?$"
+)
+# (WT input suffix, ISO 8601 designator, seconds) in _DURATION group order
+_DURATION_UNITS = (
+    ("year", "Y", 31556952), ("month", "M", 2629746), ("week", "W", 604800),
+    ("day", "D", 86400), ("hour", "H", 3600), ("minute", "M", 60), ("second", "S", 1),
+)
+_NUMBER_TOKEN = re.compile(r"(?<![\w.])-?\d+(?:\.(\d+))?(?![\w.])")
+
+
+def _jitter_duration(value: str, draw, ranges: dict[str, dict]) -> str:
+    """
+    Jitter an ISO 8601 duration ±10% (or to draw() seconds), re-emitted in
+    the designators the original used; each field is clamped to its WT range.
+    """
+    m = _DURATION.match(value)
+    if not m or not any(m.groups()[1:]):
+        return value
+    fields = [i for i, g in enumerate(m.groups()[1:]) if g is not None]
+    total = sum(float(m.group(i + 2)) * _DURATION_UNITS[i][2] for i in fields)
+    left = float(draw()) if draw else total * random.uniform(0.9, 1.1)
+    parts: dict[int, int] = {}
+    for i in fields:
+        suffix, _, seconds = _DURATION_UNITS[i]
+        q = round(left / seconds) if i == fields[-1] else int(left // seconds)
+        rng = ranges.get(suffix) or {}
+        if rng.get("min") is not None:
+            q = max(int(rng["min"]), q)
+        if rng.get("max") is not None:
+            q = min(int(rng["max"]), q)
+        parts[i] = max(0, q)
+        left -= parts[i] * seconds
+    date = "".join(f"{parts[i]}{_DURATION_UNITS[i][1]}" for i in fields if i < 4)
+    time_ = "".join(f"{parts[i]}{_DURATION_UNITS[i][1]}" for i in fields if i >= 4)
+    return f"{m.group(1) or ''}P{date}" + (f"T{time_}" if time_ else "")
+
+
+def _scramble(s: str) -> str:
+    """Same shape, new characters: digits → digits, letters → letters of the same case."""
+    out = []
+    for ch in s:
+        if ch.isdigit():
+            out.append(random.choice("0123456789"))
+        elif "a" <= ch <= "z":
+            out.append(random.choice("abcdefghijklmnopqrstuvwxyz"))
+        elif "A" <= ch <= "Z":
+            out.append(random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def _jitter_number_token(m: re.Match) -> str:
+    decimals = len(m.group(1) or "")
+    v = float(m.group(0)) * random.uniform(0.9, 1.1)
+    return f"{v:.{decimals}f}" if decimals else str(round(v))
+
+
+def _value_keys(keys: list[str], *suffixes: str) -> list[str]:
+    """The node's value keys: the bare key plus any of the given |suffixes."""
+    return [k for k in keys if "|" not in k or k.rpartition("|")[2] in suffixes]
+
+
+_RM_HANDLERS: dict[str, type] = {}
+
+
+def register_handler(*keys: str):
+    """
+    Class decorator registering a NodeHandler for rmTypes (e.g. "DV_QUANTITY")
+    or exact WT id-paths. An id-path wins over its node's rmType; a later
+    registration replaces an earlier one, so plugins can override built-ins.
+    """
+    def deco(cls: type) -> type:
+        for key in keys:
+            _RM_HANDLERS[key] = cls
+        return cls
+    return deco
+
+
+class NodeHandler:
+    """
+    Mutation for one WT node, compiled once per node by Mutator.
+
+    __init__ reads what it needs from the WT node; `draw` is the node's
+    profile sampler, or None. mutate() rewrites the keys of one node
+    instance in one composition in place; batch() does the same for
+    several compositions sharing those keys and source values.
+    """
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        self.wt_node = wt_node
+        self.draw = draw
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        raise NotImplementedError
+
+    def batch(self, outs: list[dict], keys: list[str]) -> None:
+        for out in outs:
+            self.mutate(out, keys)
+
+
+def _input_range(wt_node: dict, match) -> tuple[Optional[float], Optional[float]]:
+    """(min, max) of the first WT input for which match(input) is true."""
+    inp = next((i for i in wt_node.get("inputs") or [] if match(i)), None)
+    rng = ((inp or {}).get("validation") or {}).get("range") or {}
+    lo = float(rng["min"]) if rng.get("min") is not None else None
+    hi = float(rng["max"]) if rng.get("max") is not None else None
+    if lo is not None and hi is not None and hi < lo:
+        hi = lo
+    return lo, hi
+
+
+@register_handler("DV_QUANTITY")
+class QuantityHandler(NodeHandler):
+    """±10% jitter (or the profile draw) on |magnitude, clamped to the WT range."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        self.lo, self.hi = _input_range(wt_node, lambda i: i.get("suffix") in (None, "", "magnitude"))
+
+    def _value(self, val: float, is_float: bool):
+        v = float(self.draw()) if self.draw else float(val) * random.uniform(0.9, 1.1)
+        if self.lo is not None:
+            v = max(self.lo, v)
+        if self.hi is not None:
+            v = min(self.hi, v)
+        return round(v, 2) if is_float else round(v)
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            val = out[key]
+            if key.endswith("|magnitude") and isinstance(val, (int, float)):
+                out[key] = self._value(val, isinstance(val, float))
+
+    def batch(self, outs: list[dict], keys: list[str]) -> None:
+        for key in keys:
+            val = outs[0][key]
+            if key.endswith("|magnitude") and isinstance(val, (int, float)):
+                is_float = isinstance(val, float)
+                for out in outs:
+                    out[key] = self._value(val, is_float)
+
+
+@register_handler("DV_COUNT")
+class CountHandler(NodeHandler):
+    """Random integer in the WT range (profile draws are clamped to it), else ±5."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        self.lo, self.hi = _input_range(wt_node, lambda i: i.get("type") == "INTEGER")
+
+    def _value(self, val: int) -> int:
+        if self.draw:
+            v = round(self.draw())
+            if self.lo is not None:
+                v = max(int(self.lo), v)
+            if self.hi is not None:
+                v = min(int(self.hi), v)
+            return v
+        if self.lo is not None or self.hi is not None:
+            lo = int(self.lo) if self.lo is not None else val
+            hi = int(self.hi) if self.hi is not None else val
+            return random.randint(lo, max(lo, hi))
+        return max(0, val + random.randint(-5, 5))
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            if "|" not in key and isinstance(out[key], int):
+                out[key] = self._value(out[key])
+
+    def batch(self, outs: list[dict], keys: list[str]) -> None:
+        for key in keys:
+            val = outs[0][key]
+            if "|" not in key and isinstance(val, int):
+                for out in outs:
+                    out[key] = self._value(val)
+
+
+@register_handler("DV_CODED_TEXT")
+class CodedTextHandler(NodeHandler):
+    """Local terminology: pick from the WT code list. openehr and external terminologies: untouched."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        inputs = wt_node.get("inputs") or []
+        inp = next((i for i in inputs if i.get("suffix") == "code" and i.get("list")), None)
+        self.entries = inp["list"] if inp else []
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        if not self.entries:
+            return
+        term_key = next((k for k in keys if k.endswith("|terminology")), None)
+        if not term_key or out[term_key] != "local":
+            return
+        chosen = self.draw() if self.draw else random.choice(self.entries)
+        for key in keys:
+            if key.endswith("|code"):
+                out[key] = chosen["value"]
+            elif key.endswith("|value"):
+                out[key] = chosen.get("label", chosen["value"])
+
+
+@register_handler("DV_ORDINAL")
+class OrdinalHandler(NodeHandler):
+    """Pick from the WT list; sets |ordinal, |value and |code together."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        inputs = wt_node.get("inputs") or []
+        inp = next((i for i in inputs if i.get("type") == "CODED_TEXT" and i.get("list")), None)
+        self.entries = inp["list"] if inp else []
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        if not self.entries:
+            return
+        chosen = self.draw() if self.draw else random.choice(self.entries)
+        for key in keys:
+            if key.endswith("|ordinal"):
+                out[key] = chosen["ordinal"]
+            elif key.endswith("|value"):
+                out[key] = chosen.get("label", chosen["value"])
+            elif key.endswith("|code"):
+                out[key] = chosen["value"]
+
+
+@register_handler("DV_TEXT")
+class TextHandler(NodeHandler):
+    """
+    Constrained list (listOpen=false) → pick; free text → profile sampler or
+    corpus model; otherwise shuffle the node name's words (hex suffix if one word).
+    """
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        inputs = wt_node.get("inputs") or []
+        inp = next((i for i in inputs if i.get("type") == "TEXT"), None)
+        enum_list = (inp.get("list") or []) if inp else []
+        self.enum = enum_list if enum_list and not (inp or {}).get("listOpen", True) else None
+        self.model = None if self.enum or draw else text_model()
+        name_raw = wt_node.get("name") or ""
+        self.name = name_raw.get("value", "") if isinstance(name_raw, dict) else name_raw
+
+    def _value(self, val: str) -> str:
+        if self.enum:
+            return (self.draw() if self.draw else random.choice(self.enum))["value"]
+        if self.draw:
+            v = self.draw()
+            return v if isinstance(v, str) else v["value"]
+        if self.model:
+            return self.model.text(*_TEXT_WORDS)
+        words = (self.name or val).split()
+        if len(words) > 1:
+            random.shuffle(words)
+            return " ".join(words)
+        return (self.name or val) + " " + hex(random.randint(0, 0xFFFF))[2:]
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            if "|" not in key and isinstance(out[key], str):
+                out[key] = self._value(out[key])
+
+
+@register_handler("DV_DATE_TIME", "DV_DATE", "DV_TIME")
+class DateTimeHandler(NodeHandler):
+    """Jitter within ±15% of one day."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        self.rm_type = wt_node.get("rmType", "")
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            if "|" not in key and isinstance(out[key], str):
+                out[key] = _jitter_datetime(out[key], self.rm_type)
+
+
+@register_handler("DV_DURATION")
+class DurationHandler(NodeHandler):
+    """±10% of the total length (or draw() seconds), same designators, fields clamped to the WT ranges."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        self.ranges = {
+            i["suffix"]: ((i.get("validation") or {}).get("range") or {})
+            for i in wt_node.get("inputs") or [] if i.get("suffix")
+        }
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in _value_keys(keys, "value"):
+            if isinstance(out[key], str):
+                out[key] = _jitter_duration(out[key], self.draw, self.ranges)
+
+
+@register_handler("DV_PROPORTION")
+class ProportionHandler(NodeHandler):
+    """
+    ±10% jitter (or the profile draw) on |numerator, clamped to the WT range;
+    integral for fraction types (3, 4) and integer sources. |denominator and
+    |type are kept, so unitary and percent proportions stay consistent.
+    """
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        self.lo, self.hi = _input_range(wt_node, lambda i: i.get("suffix") == "numerator")
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        type_key = next((k for k in keys if k.endswith("|type")), None)
+        integral = str(out[type_key]) in ("3", "4") if type_key else False
+        for key in keys:
+            val = out[key]
+            if not key.endswith("|numerator") or isinstance(val, bool) or not isinstance(val, (int, float)):
+                continue
+            v = float(self.draw()) if self.draw else float(val) * random.uniform(0.9, 1.1)
+            if self.lo is not None:
+                v = max(self.lo, v)
+            if self.hi is not None:
+                v = min(self.hi, v)
+            out[key] = round(v) if integral or isinstance(val, int) else round(v, 4)
+
+
+@register_handler("DV_BOOLEAN")
+class BooleanHandler(NodeHandler):
+    """Random pick among the values the WT allows (both when unconstrained)."""
+
+    def __init__(self, wt_node: dict, draw=None) -> None:
+        super().__init__(wt_node, draw)
+        inp = next((i for i in wt_node.get("inputs") or [] if i.get("type") == "BOOLEAN"), None)
+        listed = [e.get("value") for e in (inp or {}).get("list") or []]
+        self.allowed = [v in (True, "true") for v in listed] or [True, False]
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in _value_keys(keys, "value"):
+            if isinstance(out[key], bool):
+                out[key] = random.choice(self.allowed)
+
+
+@register_handler("DV_IDENTIFIER")
+class IdentifierHandler(NodeHandler):
+    """New |id of the same shape; issuer, assigner and type are kept."""
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            if key.endswith("|id") and isinstance(out[key], str):
+                out[key] = _scramble(out[key])
+
+
+@register_handler("DV_MULTIMEDIA")
+class MultimediaHandler(NodeHandler):
+    """±10% on |size; the last |url segment's name is re-drawn with the same shape and extension."""
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in keys:
+            val = out[key]
+            if key.endswith("|size") and isinstance(val, int) and not isinstance(val, bool):
+                out[key] = max(0, round(val * random.uniform(0.9, 1.1)))
+            elif key.endswith("|url") and isinstance(val, str):
+                head, sep, tail = val.rpartition("/")
+                stem, dot, ext = tail.rpartition(".") if "." in tail else (tail, "", "")
+                out[key] = head + sep + _scramble(stem) + dot + ext
+
+
+@register_handler("DV_PARSABLE")
+class ParsableHandler(NodeHandler):
+    """±10% on standalone numbers in the value (decimal places kept); |formalism untouched."""
+
+    def mutate(self, out: dict, keys: list[str]) -> None:
+        for key in _value_keys(keys, "value"):
+            if isinstance(out[key], str):
+                out[key] = _NUMBER_TOKEN.sub(_jitter_number_token, out[key])
+
+
+@functools.lru_cache(maxsize=None)
+def load_handler_plugins() -> int:
+    """
+    Execute every *.py in HANDLERS_DIR once. Plugins see NodeHandler and
+    register_handler as globals. Returns the number of plugins loaded.
+    """
+    loaded = 0
+    for fname in sorted(f for f in os.listdir(HANDLERS_DIR) if f.endswith(".py")):
+        spec = importlib.util.spec_from_file_location(f"rm_handler_{fname[:-3]}", os.path.join(HANDLERS_DIR, fname))
+        module = importlib.util.module_from_spec(spec)
+        module.NodeHandler = NodeHandler
+        module.register_handler = register_handler
+        try:
+            spec.loader.exec_module(module)
+            loaded += 1
+        except Exception as e:
+            print(f"  [!] Handler plugin {fname}: {e}")
+    return loaded
+
+
+class Mutator:
+    """
+    mutate_flat compiled for one template. Each flat base path resolves once
+    to its WT node and handler (WT id-path registration first, then rmType),
+    and mandatory null_flavour targets are found once. mutate_batch() makes n
+    compositions from one source, dispatching each handler once per node.
+    rmTypes in `skip` are left to someone else (e.g. dates to a TimePlan).
+    """
+
+    def __init__(
+        self,
+        wt_index: dict[str, dict],
+        profile: Optional[dict[str, object]] = None,
+        skip: frozenset[str] = frozenset(),
+    ) -> None:
+        load_handler_plugins()
+        self.wt_index = wt_index
+        self.profile = profile or {}
+        self.skip = skip
+        self._by_wt: dict[str, Optional[NodeHandler]] = {}
+        self._by_base: dict[str, Optional[NodeHandler]] = {}
+        self._nf_of: dict[str, Optional[tuple[str, list, str]]] = {}
+        # Parent ELEMENT WT path → (null_flavour WT node id, WT node)
+        self.nf_by_parent_wt: dict[str, tuple[str, dict]] = {}
+        for p, n in wt_index.items():
+            if n.get("aqlPath", "").endswith("/null_flavour") and n.get("min", 0) >= 1:
+                parent, _, nf_id = p.rpartition("/")
+                self.nf_by_parent_wt[parent] = (nf_id, n)
+
+    def handler(self, base: str) -> Optional[NodeHandler]:
+        try:
+            return self._by_base[base]
+        except KeyError:
+            pass
+        h = None
+        if not _is_protected(base):
+            wt_path = wt_path_of(base)
+            if wt_path in self._by_wt:
+                h = self._by_wt[wt_path]
+            else:
+                wt_node = self.wt_index.get(wt_path)
+                rm_type = wt_node.get("rmType", "") if wt_node else ""
+                cls = _RM_HANDLERS.get(wt_path) or (_RM_HANDLERS.get(rm_type) if rm_type not in self.skip else None)
+                h = self._by_wt[wt_path] = cls(wt_node, self.profile.get(wt_path)) if cls else None
+        self._by_base[base] = h
+        return h
+
+    def _null_flavour(self, base: str) -> Optional[tuple[str, list, str]]:
+        """(null_flavour flat base, code list, terminology) to inject for base, or None."""
+        try:
+            return self._nf_of[base]
+        except KeyError:
+            pass
+        target = None
+        if not _is_protected(base):
+            wt_path = wt_path_of(base)
+            # Case 1: base IS the element (DV_CODED_TEXT / DV_TEXT elements)
+            nf_entry = self.nf_by_parent_wt.get(wt_path)
+            nf_base = None
+            if nf_entry is not None:
+                nf_base = base + "/" + nf_entry[0]
+            else:
+                # Case 2: base is value child under the element (DV_ORDINAL / DV_QUANTITY)
+                nf_entry = self.nf_by_parent_wt.get(wt_path.rsplit("/", 1)[0])
+                if nf_entry is not None:
+                    nf_base = base.rsplit("/", 1)[0] + "/" + nf_entry[0]
+            if nf_entry is not None:
+                inputs = nf_entry[1].get("inputs") or []
+                coded_inp = next((i for i in inputs if i.get("type") == "CODED_TEXT"), None)
+                if coded_inp and coded_inp.get("list"):
+                    target = (nf_base, coded_inp["list"], coded_inp.get("terminology", "openehr"))
+        self._nf_of[base] = target
+        return target
+
+    @staticmethod
+    def _groups(flat: dict) -> dict[str, list[str]]:
+        # Group keys by base path (strip |suffix so coded-text triplets are together)
+        groups: dict[str, list[str]] = {}
+        for key in flat:
+            groups.setdefault(key.partition("|")[0], []).append(key)
+        return groups
+
+    def _inject_null_flavours(self, out: dict, bases) -> None:
+        # In ehrbase FLAT, null_flavour is represented via the WT id-based path of the
+        # null_flavour node (e.g. element/coded_text_value|code), NOT element/_null_flavour.
+        # Both the element value and null_flavour can be mandatory simultaneously —
+        # so we inject null_flavour WITHOUT removing existing value keys.
+        for base in bases:
+            target = self._null_flavour(base)
+            if target is None:
+                continue
+            nf_base, nf_list, nf_term = target
+            if nf_base + "|code" in out:
+                continue
+            chosen = random.choice(nf_list)
+            out[nf_base + "|code"] = chosen["value"]
+            out[nf_base + "|value"] = chosen.get("label", chosen["value"])
+            out[nf_base + "|terminology"] = nf_term
+
+    def mutate(self, flat: dict) -> dict:
+        # Handlers assign values and never mutate them in place: a shallow copy is enough
+        out = dict(flat)
+        groups = self._groups(flat)
+        for base, keys in groups.items():
+            h = self.handler(base)
+            if h is not None:
+                h.mutate(out, keys)
+        self._inject_null_flavours(out, groups)
+        return out
+
+    def mutate_batch(self, flat: dict, n: int) -> list[dict]:
+        outs = [dict(flat) for _ in range(n)]
+        groups = self._groups(flat)
+        for base, keys in groups.items():
+            h = self.handler(base)
+            if h is not None:
+                h.batch(outs, keys)
+        for out in outs:
+            self._inject_null_flavours(out, groups)
+        return outs
+
+
+def mutate_flat(
+    flat: dict, wt_index: dict[str, dict], profile: Optional[dict[str, object]] = None
+) -> dict:
     """
     Return a mutated copy of a flat composition using WT constraints.
+    A compiled profile (see compile_profile) replaces the uniform pick or the
+    ±10% jitter for the WT paths it covers. Compiles a Mutator per call —
+    hot paths keep one Mutator per template instead.
 
-    Rules:
+    Rules (one registered NodeHandler per rmType):
       b) Skip protected path segments (category, context, language, territory,
          composer, _work_flow_id, _guideline_id, _instruction_details,
          ism_transition, annotations)
       c) DV_CODED_TEXT with terminology "openehr" → untouched
       d) DV_QUANTITY → jitter |magnitude within WT min/max range, leave |unit alone
-      e) DV_DURATION → untouched
+      e) DV_DURATION → jitter total length ±10%, same designators, per-field WT ranges
+      f) DV_PROPORTION → jitter |numerator within WT range; integral for fractions
       g) DV_CODED_TEXT with terminology "local" and WT list → pick randomly from list
       h) DV_ORDINAL → pick random entry from WT list; set |ordinal, |value, |code
       i) DV_COUNT → random integer within WT validation range
-      j) DV_TEXT → if constrained list (listOpen=false): pick randomly from list; else shuffle words from node name, append hex if single word
+      j) DV_TEXT → if constrained list (listOpen=false): pick randomly from list; else
+         corpus-model sentences when source_models/text_corpus/ has .txt files;
+         else shuffle words from node name, append hex if single word
       k) DV_DATE_TIME / DV_DATE / DV_TIME → jitter within ±15% of one day
       l) null_flavour → find mandatory null_flavour via aqlPath; inject as
          element/<nf_wt_id>|code/value/terminology; value keys kept (both can be mandatory)
+      m) DV_BOOLEAN → random pick among WT-allowed values
+      n) DV_IDENTIFIER → |id redrawn with the same shape
+      o) DV_MULTIMEDIA → jitter |size, redraw the |url file name
+      p) DV_PARSABLE → jitter standalone numbers in the value
     """
-    out = copy.deepcopy(flat)
+    return Mutator(wt_index, profile).mutate(flat)
 
-    # Group keys by base path (strip |suffix so coded-text triplets are together)
-    groups: dict[str, list[str]] = {}
-    for key in flat:
-        groups.setdefault(key.split("|")[0], []).append(key)
 
-    for base, keys in groups.items():
-        if _is_protected(base):
-            continue
+# ── local validation ───────────────────────────────────────────────────────────
 
-        wt_node = wt_index.get(wt_path_of(base))
-        if wt_node is None:
-            continue
+_DATE_FORMATS = {
+    "DV_DATE_TIME": re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$"),
+    "DV_DATE":      re.compile(r"^\d{4}(-\d{2}(-\d{2})?)?$"),
+    "DV_TIME":      re.compile(r"^\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$"),
+}
+
+
+def _range_check(rng: Optional[dict], integer: bool):
+    """Check for a number against a WT validation range (minOp/maxOp aware)."""
+    lo, hi = (rng or {}).get("min"), (rng or {}).get("max")
+    lo_strict = (rng or {}).get("minOp") == ">"
+    hi_strict = (rng or {}).get("maxOp") == "<"
+    types = (int,) if integer else (int, float)
+
+    def check(v) -> Optional[str]:
+        if isinstance(v, bool) or not isinstance(v, types):
+            return "type"
+        if lo is not None and (v <= lo if lo_strict else v < lo):
+            return "range"
+        if hi is not None and (v >= hi if hi_strict else v > hi):
+            return "range"
+        return None
+    return check
 
-        rm_type = wt_node.get("rmType", "")
 
-        # ── DV_QUANTITY ────────────────────────────────────────────────────────
+def _member_check(allowed: set, rule: str = "code"):
+    def check(v) -> Optional[str]:
+        return None if v in allowed else rule
+    return check
+
+
+def _type_check(types: tuple):
+    def check(v) -> Optional[str]:
+        return None if isinstance(v, types) and not (bool not in types and isinstance(v, bool)) else "type"
+    return check
+
+
+class FlatValidator:
+    """
+    Pre-screens flat compositions against the webtemplate before POST.
+
+    Compiled once per template into {(WT id-path, suffix): check} plus, per
+    parent WT path, the mandatory (min >= 1) DV_* children. check() returns
+    [(flat key, WT path, rule)] with rule in range / code / type /
+    null_flavour / mandatory; repair() reverts offending keys to the
+    pre-mutation values, which came from the CDR's own example.
+    """
+
+    def __init__(self, wt_index: dict[str, dict], skeleton: Optional[dict] = None) -> None:
+        self.checks: dict[tuple[str, str], object] = {}
+        self.mandatory: dict[str, list[str]] = {}
+        self._wt_of: dict[str, str] = {}
+        for path, node in wt_index.items():
+            rm_type = node.get("rmType", "")
+            if not rm_type.startswith("DV_") or _is_protected(path):
+                continue
+            if node.get("min", 0) >= 1 and "/" in path:
+                parent, child = path.rsplit("/", 1)
+                # Choice ELEMENTs list every allowed DV_* child as mandatory; only one is present
+                if (wt_index.get(parent) or {}).get("rmType") != "ELEMENT":
+                    self.mandatory.setdefault(parent, []).append(child)
+            self._compile_node(path, node, rm_type)
+        if skeleton:
+            self._calibrate(skeleton)
+
+    def _compile_node(self, path: str, node: dict, rm_type: str) -> None:
+        inputs = node.get("inputs") or []
+        checks = self.checks
         if rm_type == "DV_QUANTITY":
-            inputs = wt_node.get("inputs") or []
-            mag_inp = next(
-                (i for i in inputs if i.get("suffix") in (None, "", "magnitude")), None
-            )
-            rng = (mag_inp.get("validation") or {}).get("range") if mag_inp else None
-            for key in keys:
-                if not key.endswith("|magnitude"):
-                    continue
-                val = out[key]
-                if not isinstance(val, (int, float)):
-                    continue
-                jittered = float(val) * random.uniform(0.9, 1.1)
-                if rng:
-                    lo = float(rng.get("min", jittered))
-                    hi = float(rng.get("max", jittered))
-                    if hi < lo:
-                        hi = lo
-                    jittered = max(lo, min(hi, jittered))
-                out[key] = round(jittered, 2) if isinstance(val, float) else round(jittered)
-
-        # ── DV_CODED_TEXT ──────────────────────────────────────────────────────
+            mag = next((i for i in inputs if i.get("suffix") in (None, "", "magnitude")), None)
+            checks[(path, "magnitude")] = _range_check((mag or {}).get("validation", {}).get("range"), False)
+            unit = next((i for i in inputs if i.get("suffix") == "unit" and i.get("list")), None)
+            if unit:
+                checks[(path, "unit")] = _member_check({u["value"] for u in unit["list"]})
+        elif rm_type == "DV_COUNT":
+            inp = next((i for i in inputs if i.get("type") == "INTEGER"), None)
+            checks[(path, "")] = _range_check((inp or {}).get("validation", {}).get("range"), True)
         elif rm_type == "DV_CODED_TEXT":
-            term_key = next((k for k in keys if k.endswith("|terminology")), None)
-            terminology = flat.get(term_key, "") if term_key else ""
-            if terminology == "openehr":
-                continue
-            if terminology == "local":
-                inputs = wt_node.get("inputs") or []
-                code_inp = next(
-                    (i for i in inputs if i.get("suffix") == "code" and i.get("list")),
-                    None,
+            inp = next((i for i in inputs if i.get("suffix") == "code" and i.get("list")), None)
+            if inp:
+                is_nf = node.get("aqlPath", "").endswith("/null_flavour")
+                checks[(path, "code")] = _member_check(
+                    {e["value"] for e in inp["list"]}, "null_flavour" if is_nf else "code"
                 )
-                if code_inp:
-                    chosen = random.choice(code_inp["list"])
-                    for key in keys:
-                        if key.endswith("|code"):
-                            out[key] = chosen["value"]
-                        elif key.endswith("|value"):
-                            out[key] = chosen.get("label", chosen["value"])
-
-        # ── DV_ORDINAL ─────────────────────────────────────────────────────────
+                if is_nf:
+                    checks[(path, "value")] = _member_check(
+                        {e.get("label", e["value"]) for e in inp["list"]}, "null_flavour"
+                    )
         elif rm_type == "DV_ORDINAL":
-            inputs = wt_node.get("inputs") or []
-            coded_inp = next(
-                (i for i in inputs if i.get("type") == "CODED_TEXT" and i.get("list")),
-                None,
-            )
-            if coded_inp:
-                chosen = random.choice(coded_inp["list"])
-                for key in keys:
-                    if key.endswith("|ordinal"):
-                        out[key] = chosen["ordinal"]
-                    elif key.endswith("|value"):
-                        out[key] = chosen.get("label", chosen["value"])
-                    elif key.endswith("|code"):
-                        out[key] = chosen["value"]
-
-        # ── DV_COUNT ───────────────────────────────────────────────────────────
-        elif rm_type == "DV_COUNT":
-            inputs = wt_node.get("inputs") or []
-            int_inp = next((i for i in inputs if i.get("type") == "INTEGER"), None)
-            rng = (int_inp.get("validation") or {}).get("range") if int_inp else None
-            for key in keys:
-                if "|" not in key and isinstance(out[key], int):
-                    if rng:
-                        lo = int(rng.get("min", out[key]))
-                        hi = int(rng.get("max", out[key]))
-                        out[key] = random.randint(lo, hi)
-                    else:
-                        out[key] = max(0, out[key] + random.randint(-5, 5))
-
-        # ── DV_TEXT ────────────────────────────────────────────────────────────
+            inp = next((i for i in inputs if i.get("type") == "CODED_TEXT" and i.get("list")), None)
+            if inp:
+                checks[(path, "code")] = _member_check({e["value"] for e in inp["list"]})
+                checks[(path, "ordinal")] = _member_check({e.get("ordinal") for e in inp["list"]})
         elif rm_type == "DV_TEXT":
-            inputs = wt_node.get("inputs") or []
-            text_inp = next((i for i in inputs if i.get("type") == "TEXT"), None)
-            enum_list = (text_inp.get("list") or []) if text_inp else []
-            list_open = text_inp.get("listOpen", True) if text_inp else True
-            if enum_list and not list_open:
-                # Constrained DV_TEXT: value must be one of the listed options
-                for key in keys:
-                    if "|" not in key and isinstance(out[key], str):
-                        out[key] = random.choice(enum_list)["value"]
+            inp = next((i for i in inputs if i.get("type") == "TEXT"), None)
+            if inp and inp.get("list") and not inp.get("listOpen", True):
+                checks[(path, "")] = _member_check({e["value"] for e in inp["list"]})
             else:
-                name_raw = wt_node.get("name") or ""
-                node_name = name_raw.get("value", "") if isinstance(name_raw, dict) else name_raw
-                for key in keys:
-                    if "|" not in key and isinstance(out[key], str):
-                        words = (node_name or out[key]).split()
-                        if len(words) > 1:
-                            random.shuffle(words)
-                            out[key] = " ".join(words)
-                        else:
-                            out[key] = (node_name or out[key]) + " " + hex(random.randint(0, 0xFFFF))[2:]
-
-        # ── DV_DATE_TIME / DV_DATE / DV_TIME ──────────────────────────────────
-        elif rm_type in ("DV_DATE_TIME", "DV_DATE", "DV_TIME"):
-            for key in keys:
-                if "|" not in key and isinstance(out[key], str):
-                    out[key] = _jitter_datetime(out[key], rm_type)
-
-        # DV_DURATION and everything else → skip
-
-    # ── Inject mandatory null_flavour attributes ────────────────────────────────
-    # In ehrbase FLAT, null_flavour is represented via the WT id-based path of the
-    # null_flavour node (e.g. element/coded_text_value|code), NOT element/_null_flavour.
-    # Both the element value and null_flavour can be mandatory simultaneously —
-    # so we inject null_flavour WITHOUT removing existing value keys.
-
-    # Pre-build: parent ELEMENT WT path → (null_flavour WT node id, WT node)
-    nf_by_parent_wt: dict[str, tuple[str, dict]] = {}
-    for _p, _n in wt_index.items():
-        if _n.get("aqlPath", "").endswith("/null_flavour") and _n.get("min", 0) >= 1:
-            parent = _p.rsplit("/", 1)[0]
-            nf_id = _p.rsplit("/", 1)[1]  # e.g., "coded_text_value"
-            nf_by_parent_wt[parent] = (nf_id, _n)
-
-    for base in list(groups.keys()):
-        if _is_protected(base):
-            continue
-        wt_path = wt_path_of(base)
-        # Case 1: base IS the element (DV_CODED_TEXT / DV_TEXT elements)
-        nf_entry = nf_by_parent_wt.get(wt_path)
-        if nf_entry is not None:
-            nf_id, nf_wt_node = nf_entry
-            nf_base = base + "/" + nf_id
-        else:
-            # Case 2: base is value child under the element (DV_ORDINAL / DV_QUANTITY)
-            parent_wt_path = wt_path.rsplit("/", 1)[0]
-            nf_entry = nf_by_parent_wt.get(parent_wt_path)
-            if nf_entry is None:
-                continue
-            nf_id, nf_wt_node = nf_entry
-            nf_base = base.rsplit("/", 1)[0] + "/" + nf_id
-        # Skip if already present
-        if any(k.startswith(nf_base + "|") for k in out):
-            continue
-        # Get constrained list
-        inputs = nf_wt_node.get("inputs") or []
-        coded_inp = next((i for i in inputs if i.get("type") == "CODED_TEXT"), None)
-        if not coded_inp:
-            continue
-        nf_list = coded_inp.get("list") or []
-        nf_term = coded_inp.get("terminology", "openehr")
-        if not nf_list:
-            continue
-        # Inject null_flavour — value keys are kept; both can be mandatory in the same template
-        chosen = random.choice(nf_list)
-        out[nf_base + "|code"] = chosen["value"]
-        out[nf_base + "|value"] = chosen.get("label", chosen["value"])
-        out[nf_base + "|terminology"] = nf_term
+                checks[(path, "")] = _type_check((str,))
+        elif rm_type in _DATE_FORMATS:
+            fmt = _DATE_FORMATS[rm_type]
+            checks[(path, "")] = lambda v, _f=fmt: None if isinstance(v, str) and _f.match(v) else "type"
+        elif rm_type == "DV_BOOLEAN":
+            checks[(path, "")] = _type_check((bool,))
+
+    def _calibrate(self, skeleton: dict) -> None:
+        """Drop checks the CDR's own example fails — the WT reading was too strict."""
+        for key, wt, rule in self.check(skeleton):
+            if rule == "mandatory":
+                parent, child = wt.rsplit("/", 1)
+                if child in self.mandatory.get(parent, ()):
+                    self.mandatory[parent].remove(child)
+            else:
+                self.checks.pop((wt, key.partition("|")[2]), None)
+
+    def wt_of(self, base: str) -> str:
+        wt = self._wt_of.get(base)
+        if wt is None:
+            wt = self._wt_of[base] = wt_path_of(base)
+        return wt
+
+    def check(self, flat: dict) -> list[tuple[str, str, str]]:
+        problems: list[tuple[str, str, str]] = []
+        checks, wt_of = self.checks, self.wt_of
+        present: set[str] = set()
+        for key, value in flat.items():
+            base, _, suffix = key.partition("|")
+            wt = wt_of(base)
+            i = base.rfind(":")
+            present.add(base[:i] if i > base.rfind("/") else base)
+            fn = checks.get((wt, suffix))
+            if fn is not None:
+                rule = fn(value)
+                if rule:
+                    problems.append((key, wt, rule))
+        if self.mandatory:
+            for base in {b.rsplit("/", 1)[0] for b in present if "/" in b}:
+                for child in self.mandatory.get(wt_of(base), ()):
+                    if f"{base}/{child}" not in present:
+                        problems.append((f"{base}/{child}", f"{wt_of(base)}/{child}", "mandatory"))
+        return problems
+
+    @staticmethod
+    def repair(flat: dict, source: dict, problems: list[tuple[str, str, str]]) -> dict:
+        """Revert offending keys (and, for missing nodes, copy keys) from source."""
+        for key, _, rule in problems:
+            if rule == "mandatory":
+                prefixes = (key + "|", key + ":")
+                for k, v in source.items():
+                    if k == key or k.startswith(prefixes):
+                        flat[k] = v
+            elif key in source:
+                flat[key] = source[key]
+            else:
+                flat.pop(key, None)
+        return flat
 
-    return out
+
+# ── uniqueness ─────────────────────────────────────────────────────────────────
+
+class BloomFilter:
+    """
+    Bloom filter over 128-bit digests with a hard memory cap.
+
+    Sized for `expected` items at fp_target, shrunk to max_bytes if needed;
+    k probe positions come from double hashing the two digest halves.
+    """
+
+    def __init__(
+        self, expected: int, fp_target: float = 1e-3, max_bytes: int = _BLOOM_MAX_BYTES
+    ) -> None:
+        n = max(1, expected)
+        bits = int(-n * math.log(fp_target) / (math.log(2) ** 2))
+        bits = max(64, min(bits, max_bytes * 8))
+        self.m = bits
+        self.k = max(1, round(bits / n * math.log(2)))
+        self.bits = bytearray((bits + 7) // 8)
+        self.n = n
+
+    def add(self, digest: bytes) -> bool:
+        """Set the digest's bits; True if all were already set (probably seen)."""
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        bits, m = self.bits, self.m
+        seen = True
+        for i in range(self.k):
+            pos = (h1 + i * h2) % m
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                seen = False
+        return seen
+
+    @property
+    def fp_rate(self) -> float:
+        """Expected false-positive rate once `expected` items are in."""
+        return (1 - math.exp(-self.k * self.n / self.m)) ** self.k
+
+
+class UniquenessGuard:
+    """
+    Detects repeated compositions in a run.
+
+    A composition's identity is a blake2b digest of its keys and values,
+    excluding volatile keys — protected segments (context, composer, …) and
+    DV_DATE_TIME / DV_DATE / DV_TIME nodes, which differ between otherwise
+    identical compositions. Because of Bloom false positives the reported
+    distinct ratio is a lower bound.
+    """
+
+    _VOLATILE_TYPES = frozenset({"DV_DATE_TIME", "DV_DATE", "DV_TIME"})
+
+    def __init__(self, expected: int) -> None:
+        self.bloom = BloomFilter(expected)
+        self._volatile: dict[str, bool] = {}
+        self.checked = self.collisions = self.regenerated = self.duplicates = 0
+
+    def _is_volatile(self, base: str, wt_index: dict[str, dict]) -> bool:
+        v = self._volatile.get(base)
+        if v is None:
+            node = wt_index.get(wt_path_of(base)) or {}
+            v = self._volatile[base] = (
+                _is_protected(base) or node.get("rmType") in self._VOLATILE_TYPES
+            )
+        return v
+
+    def digest(self, flat: dict, wt_index: dict[str, dict]) -> bytes:
+        parts = [
+            f"{k}\x1f{v!r}"
+            for k, v in flat.items()
+            if not self._is_volatile(k.partition("|")[0], wt_index)
+        ]
+        return hashlib.blake2b("\x1e".join(parts).encode(), digest_size=16).digest()
+
+    def seen(self, flat: dict, wt_index: dict[str, dict]) -> bool:
+        """Record flat; True if an identical composition was (probably) seen before."""
+        self.checked += 1
+        hit = self.bloom.add(self.digest(flat, wt_index))
+        if hit:
+            self.collisions += 1
+        return hit
+
+    def report(self) -> str:
+        emitted = self.checked - self.regenerated
+        distinct = emitted - self.duplicates
+        ratio = distinct / emitted if emitted else 1.0
+        return (
+            f"[*] Uniqueness: distinct ≥ {distinct:,}/{emitted:,} ({ratio:.4%}) | "
+            f"regenerated {self.regenerated:,} | filter {len(self.bloom.bits) / 2**20:.1f} MB, "
+            f"k={self.bloom.k}, est. false-positive {self.bloom.fp_rate:.3%}"
+        )
 
 
 # ── flat composition helpers ───────────────────────────────────────────────────
@@ -322,6 +1240,674 @@ def strip_canonical_uid(comp: dict) -> dict:
     return comp
 
 
+# ── canonical mutation ─────────────────────────────────────────────────────────
+
+_AQL_NAME_PREDICATE = re.compile(r"\[([^\],\s]+)(?:,[^\]]*|\s+and\s[^\]]*)\]")
+_CANONICAL_SKIP_ATTRS = frozenset({"name", "null_flavour", "math_function", "archetype_details"})
+
+
+def _norm_aql(path: str) -> str:
+    """Drop name predicates: '/items[at0004,'Systolic']' -> '/items[at0004]'."""
+    return _AQL_NAME_PREDICATE.sub(r"[\1]", path)
+
+
+class CanonicalMutator:
+    """
+    Value variation for one canonical composition, compiled in one walk.
+
+    Every DV_QUANTITY / DV_COUNT magnitude, local DV_CODED_TEXT, DV_ORDINAL
+    and DV_DATE_TIME / DV_DATE / DV_TIME value becomes a (JSON pointer,
+    writer) pair. The WT node, when the template's webtemplate is on disk,
+    is found by the aqlPath built from the `archetype_node_id`s on the way
+    down and checked against `_type`. apply() copies only the containers on
+    written paths, so each variant shares everything else with the source.
+    """
+
+    def __init__(
+        self,
+        comp: dict,
+        wt_index: Optional[dict[str, dict]] = None,
+        profile: Optional[dict[str, object]] = None,
+    ) -> None:
+        self.source = comp
+        self.profile = profile or {}
+        self.by_aql: dict[str, list[tuple[str, dict]]] = {}
+        for path, node in (wt_index or {}).items():
+            if node.get("aqlPath"):
+                self.by_aql.setdefault(_norm_aql(node["aqlPath"]), []).append((path, node))
+        self.writes: list[tuple[tuple, object]] = []
+        self._walk(comp, (), "")
+
+    def _wt(self, aql: str, rm_type: str) -> tuple[Optional[str], dict]:
+        cands = self.by_aql.get(aql) or []
+        return next(((p, n) for p, n in cands if n.get("rmType") == rm_type), (None, {}))
+
+    def _walk(self, node: dict, pointer: tuple, aql: str) -> None:
+        rm_type = node.get("_type", "")
+        if rm_type.startswith("DV_") and self._compile(node, pointer, aql, rm_type):
+            return
+        for attr, child in node.items():
+            if attr in _CANONICAL_SKIP_ATTRS or attr in _PROTECTED_SEGMENTS:
+                continue
+            items = enumerate(child) if isinstance(child, list) else [(None, child)]
+            for i, item in items:
+                if not isinstance(item, dict):
+                    continue
+                nid = item.get("archetype_node_id")
+                self._walk(
+                    item,
+                    pointer + ((attr,) if i is None else (attr, i)),
+                    f"{aql}/{attr}[{nid}]" if nid else f"{aql}/{attr}",
+                )
+
+    def _compile(self, dv: dict, pointer: tuple, aql: str, rm_type: str) -> bool:
+        """Add writes for one DV_* value; True if it is fully handled (no descent)."""
+        wt_path, wt_node = self._wt(aql, rm_type)
+        draw = self.profile.get(wt_path) if wt_path else None
+        if rm_type in ("DV_QUANTITY", "DV_COUNT"):
+            val = dv.get("magnitude")
+            if isinstance(val, bool) or not isinstance(val, (int, float)):
+                return True
+            if rm_type == "DV_QUANTITY":
+                lo, hi = _input_range(wt_node, lambda i: i.get("suffix") in (None, "", "magnitude"))
+            else:
+                lo, hi = _input_range(wt_node, lambda i: i.get("type") == "INTEGER")
+            is_float = isinstance(val, float)
+
+            def jitter(v, _lo=lo, _hi=hi, _f=is_float, _d=draw, _count=rm_type == "DV_COUNT"):
+                if _d:
+                    x = float(_d())
+                elif _count and (_lo is not None or _hi is not None):
+                    x = random.uniform(_lo if _lo is not None else v, _hi if _hi is not None else v)
+                else:
+                    x = v * random.uniform(0.9, 1.1)
+                if _lo is not None:
+                    x = max(_lo, x)
+                if _hi is not None:
+                    x = min(_hi, x)
+                return round(x, 2) if _f else round(x)
+            self.writes.append((pointer + ("magnitude",), jitter))
+            return True
+
+        if rm_type == "DV_CODED_TEXT":
+            code = dv.get("defining_code") or {}
+            if (code.get("terminology_id") or {}).get("value") != "local":
+                return True
+            inputs = wt_node.get("inputs") or []
+            inp = next((i for i in inputs if i.get("suffix") == "code" and i.get("list")), None)
+            if not inp:
+                return True
+            pick = draw or functools.partial(random.choice, inp["list"])
+
+            def recode(v, _pick=pick):
+                chosen = _pick()
+                return {
+                    **v, "value": chosen.get("label", chosen["value"]),
+                    "defining_code": {**v["defining_code"], "code_string": chosen["value"]},
+                }
+            self.writes.append((pointer, recode))
+            return True
+
+        if rm_type == "DV_ORDINAL":
+            inputs = wt_node.get("inputs") or []
+            inp = next((i for i in inputs if i.get("type") == "CODED_TEXT" and i.get("list")), None)
+            if not inp or not isinstance(dv.get("symbol"), dict):
+                return True
+            pick = draw or functools.partial(random.choice, inp["list"])
+
+            def reorder(v, _pick=pick):
+                chosen = _pick()
+                symbol = v["symbol"]
+                return {
+                    **v, "value": chosen["ordinal"],
+                    "symbol": {
+                        **symbol, "value": chosen.get("label", chosen["value"]),
+                        "defining_code": {**(symbol.get("defining_code") or {}), "code_string": chosen["value"]},
+                    },
+                }
+            self.writes.append((pointer, reorder))
+            return True
+
+        if rm_type in _DATE_RM_TYPES:
+            # As _jitter_datetime: ±15% of one day; a DV_DATE never moves (under
+            # a day), a DV_TIME is clamped to 00:00:00–23:59:59 instead of wrapping
+            val = dv.get("value")
+            compiled = _compile_date(val, rm_type, 0) if isinstance(val, str) else None
+            if compiled and rm_type != "DV_DATE":
+                epoch, fmt = compiled
+                spread = 12960
+                if rm_type == "DV_TIME":
+                    jitter = lambda _v, _e=epoch, _fmt=fmt: _fmt(
+                        max(0, min(86399, _e + random.randint(-spread, spread)))
+                    )
+                else:
+                    jitter = lambda _v, _e=epoch, _fmt=fmt: _fmt(_e + random.randint(-spread, spread))
+                self.writes.append((pointer + ("value",), jitter))
+            return True
+        return False
+
+    def apply(self) -> dict:
+        """A new variant: containers on written paths are copied, the rest is shared."""
+        src = self.source
+        out = dict(src)
+        copied: dict[int, object] = {id(src): out}
+        for pointer, write in self.writes:
+            orig, new = src, out
+            for seg in pointer[:-1]:
+                child = orig[seg]
+                child_new = copied.get(id(child))
+                if child_new is None:
+                    child_new = copied[id(child)] = list(child) if isinstance(child, list) else dict(child)
+                    new[seg] = child_new
+                orig, new = child, child_new
+            new[pointer[-1]] = write(orig[pointer[-1]])
+        return out
+
+
+# ── structural variation ───────────────────────────────────────────────────────
+
+class _ExpNode:
+    """
+    Compiled subtree of a flat skeleton.
+      static — (relative key, skeleton key) pairs that never change shape
+      varied — ("fixed", seg, node) or ("repeat", sep, name, lo, hi, [nodes])
+    """
+    __slots__ = ("static", "varied")
+
+    def __init__(self) -> None:
+        self.static: list[tuple[str, str]] = []
+        self.varied: list[tuple] = []
+
+
+def compile_expansion(
+    skeleton: dict, wt_index: dict[str, dict], max_repeat: int
+) -> Optional[_ExpNode]:
+    """
+    Compile a key plan that re-indexes repeating subtrees (event:N, entries…).
+
+    Indexed segments whose WT node allows more than one occurrence become
+    "repeat" groups with bounds [max(1, WT min), min(WT max, max_repeat)];
+    subtrees without such groups collapse into precomputed static key lists.
+    Returns None when nothing can vary.
+    """
+    if max_repeat < 1:
+        return None
+
+    # Trie of the skeleton: {"leaves": [(suffix, key)], "groups": {name: group}}
+    root: dict = {"leaves": [], "groups": {}}
+    for key in skeleton:
+        path, bar, suffix = key.partition("|")
+        node, wt_parts = root, []
+        for seg in path.split("/"):
+            name, colon, idx = seg.partition(":")
+            wt_parts.append(name)
+            group = node["groups"].setdefault(
+                name, {"indexed": bool(colon), "wt": "/".join(wt_parts), "instances": {}}
+            )
+            node = group["instances"].setdefault(
+                int(idx) if colon else 0, {"leaves": [], "groups": {}}
+            )
+        node["leaves"].append((bar + suffix, key))
+
+    def freeze(node: dict, sep: str) -> _ExpNode:
+        out = _ExpNode()
+        out.static.extend(node["leaves"])
+        for name, group in node["groups"].items():
+            wt_node = wt_index.get(group["wt"]) or {}
+            wt_max = wt_node.get("max", 1)
+            if group["indexed"] and (wt_max == -1 or wt_max > 1):
+                lo = max(1, wt_node.get("min", 0))
+                hi = max(lo, min(wt_max, max_repeat) if wt_max > 0 else max_repeat)
+                insts = [freeze(group["instances"][i], "/") for i in sorted(group["instances"])]
+                out.varied.append(("repeat", sep, name, lo, hi, insts))
+                continue
+            for idx, inst in sorted(group["instances"].items()):
+                seg = sep + (f"{name}:{idx}" if group["indexed"] else name)
+                child = freeze(inst, "/")
+                if child.varied:
+                    out.varied.append(("fixed", seg, child))
+                else:
+                    out.static.extend((seg + rel, src) for rel, src in child.static)
+        return out
+
+    plan = freeze(root, "")
+    return plan if plan.varied else None
+
+
+def expand_flat(plan: _ExpNode, skeleton: dict) -> dict:
+    """A new flat composition from plan: repeat groups get a random instance count."""
+    out: dict = {}
+
+    def emit(node: _ExpNode, prefix: str) -> None:
+        for rel, src in node.static:
+            out[prefix + rel] = skeleton[src]
+        for item in node.varied:
+            if item[0] == "fixed":
+                emit(item[2], prefix + item[1])
+                continue
+            _, sep, name, lo, hi, insts = item
+            for j in range(random.randint(lo, hi)):
+                emit(insts[j % len(insts)], f"{prefix}{sep}{name}:{j}")
+
+    emit(plan, "")
+    return out
+
+
+# ── EHR scheduling ─────────────────────────────────────────────────────────────
+
+def plan_ehr_quotas(total: int, spec: tuple) -> list[int]:
+    """
+    Per-EHR composition counts summing to total.
+      ("fixed", n)        every EHR gets n
+      ("range", a, b)     uniform integer in [a, b]
+      ("longtail", m)     lognormal with median m (σ = 1), capped at 50 × m
+    """
+    kind = spec[0]
+    if kind == "fixed":
+        draw = lambda: spec[1]
+    elif kind == "range":
+        draw = functools.partial(random.randint, spec[1], spec[2])
+    elif kind == "longtail":
+        mu, cap = math.log(spec[1]), 50 * spec[1]
+        draw = lambda: min(cap, max(1, round(random.lognormvariate(mu, 1.0))))
+    else:
+        raise ValueError(f"Unknown EHR distribution {kind!r}")
+    quotas: list[int] = []
+    left = total
+    while left > 0:
+        q = min(left, max(1, draw()))
+        quotas.append(q)
+        left -= q
+    return quotas
+
+
+class EhrScheduler:
+    """
+    Hands out EHRs for composition writes according to per-EHR quotas.
+
+    Each writer holds a cursor; a cursor leases one EHR at a time and uses
+    it for a run of up to run_length consecutive compositions, so an EHR's
+    writes arrive in ordered runs and never overlap (one lease per EHR).
+    A writer that finds every EHR with quota left leased waits for a release.
+    Quotas sum to the run total and every composition asks for exactly one
+    EHR, so they run out only when the run is complete.
+    """
+
+    def __init__(self, ehr_ids: list[str], quotas: list[int], run_length: int = _EHR_RUN) -> None:
+        self.ehr_ids = ehr_ids
+        self.run_length = max(1, run_length)
+        self.free: collections.deque[list] = collections.deque(
+            [ehr, q] for ehr, q in zip(ehr_ids, quotas)
+        )
+        self.leased = 0
+        self._released = asyncio.Event()
+        self.written: dict[str, int] = {}
+
+    async def lease(self) -> Optional[list]:
+        """[ehr_id, quota left] or None once every quota is used up."""
+        while not self.free:
+            if not self.leased:
+                return None
+            self._released.clear()
+            await self._released.wait()
+        self.leased += 1
+        return self.free.popleft()
+
+    def release(self, entry: list) -> None:
+        self.leased -= 1
+        if entry[1] > 0:
+            self.free.append(entry)
+        self._released.set()
+
+    def cursor(self) -> "EhrCursor":
+        return EhrCursor(self)
+
+    def summary(self) -> str:
+        sizes = sorted(self.written.values())
+        if not sizes:
+            return "[*] EHRs: none written"
+        return (
+            f"[*] EHRs written: {len(sizes):,} | compositions per EHR "
+            f"min {sizes[0]} / median {statistics.median(sizes):g} / max {sizes[-1]}"
+        )
+
+
+class EhrCursor:
+    """One writer's view of an EhrScheduler; close() when the writer is done."""
+
+    def __init__(self, scheduler: EhrScheduler) -> None:
+        self.s = scheduler
+        self.entry: Optional[list] = None
+        self.run_left = 0
+
+    async def next(self) -> str:
+        s = self.s
+        if self.entry is None or self.run_left == 0 or self.entry[1] == 0:
+            self.close()
+            self.entry = await s.lease()
+            if self.entry is None:
+                raise RuntimeError("EHR quotas exhausted: more compositions than planned")
+            self.run_left = min(s.run_length, self.entry[1])
+        self.entry[1] -= 1
+        self.run_left -= 1
+        ehr_id = self.entry[0]
+        s.written[ehr_id] = s.written.get(ehr_id, 0) + 1
+        return ehr_id
+
+    def close(self) -> None:
+        if self.entry is not None:
+            self.s.release(self.entry)
+            self.entry = None
+
+
+# ── longitudinal timelines ─────────────────────────────────────────────────────
+
+_DATE_TIME_PARTS = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?(.*)$")
+_DATE_PARTS = re.compile(r"^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?$")
+_TIME_PARTS = re.compile(r"^(\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?(.*)$")
+_CONTEXT_TIMES = ("/context/start_time", "/context/end_time")
+_LAST_INDEX = re.compile(r":(\d+)(?!.*:\d)")
+_DATE_RM_TYPES = frozenset({"DV_DATE_TIME", "DV_DATE", "DV_TIME"})
+
+
+def _days_from_civil(y: int, m: int, d: int) -> int:
+    """Days since 1970-01-01 (Hinnant's days_from_civil, pure integer arithmetic)."""
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+@functools.lru_cache(maxsize=8192)
+def _civil_from_days(days: int) -> str:
+    """'YYYY-MM-DD' for days since 1970-01-01 (inverse of _days_from_civil)."""
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    return f"{yoe + era * 400 + (m <= 2):04d}-{m:02d}-{d:02d}"
+
+
+def _clock(seconds: int, with_seconds: bool) -> str:
+    h, rem = divmod(seconds % 86400, 3600)
+    return f"{h:02d}:{rem // 60:02d}:{rem % 60:02d}" if with_seconds else f"{h:02d}:{rem // 60:02d}"
+
+
+def _compile_date(value: str, rm_type: str, day: int) -> Optional[tuple[int, object]]:
+    """
+    (epoch seconds, formatter(epoch) -> str) for a date/time string, detected
+    once. DV_TIME values are placed on `day` (days since epoch). The formatter
+    keeps the source precision, fraction and zone suffix text.
+    """
+    if rm_type == "DV_DATE_TIME":
+        m = _DATE_TIME_PARTS.match(value)
+        if not m:
+            return None
+        y, mo, d, h, mi, s = (int(g or 0) for g in m.groups()[:6])
+        with_s, tail = m.group(6) is not None, (m.group(7) or "") + m.group(8)
+        epoch = _days_from_civil(y, mo, d) * 86400 + h * 3600 + mi * 60 + s
+        return epoch, lambda t: f"{_civil_from_days(t // 86400)}T{_clock(t, with_s)}{tail}"
+    if rm_type == "DV_DATE":
+        m = _DATE_PARTS.match(value)
+        if not m:
+            return None
+        width = 4 + 3 * sum(g is not None for g in m.groups()[1:])
+        epoch = _days_from_civil(int(m.group(1)), int(m.group(2) or 1), int(m.group(3) or 1)) * 86400
+        return epoch, lambda t: _civil_from_days(t // 86400)[:width]
+    if rm_type == "DV_TIME":
+        m = _TIME_PARTS.match(value)
+        if not m:
+            return None
+        h, mi, s = (int(g or 0) for g in m.groups()[:3])
+        with_s, tail = m.group(3) is not None, (m.group(4) or "") + m.group(5)
+        return day * 86400 + h * 3600 + mi * 60 + s, lambda t: _clock(t, with_s) + tail
+    return None
+
+
+class TimePlan:
+    """
+    Date slots and trendable quantities of one skeleton, compiled once.
+
+    Every date/time key becomes (offset from the skeleton's anchor, formatter)
+    — the anchor is context/start_time, else the earliest DV_DATE_TIME — so
+    stamping a composition at a new anchor is integer addition plus string
+    formatting. Keys added by repeat expansion reuse their WT path's slot,
+    stepped by the spacing seen between skeleton instances.
+    """
+
+    def __init__(self, skeleton: dict, wt_index: dict[str, dict]) -> None:
+        typed: dict[str, str] = {}
+        for key, value in skeleton.items():
+            if "|" in key or not isinstance(value, str):
+                continue
+            rm_type = (wt_index.get(wt_path_of(key)) or {}).get("rmType")
+            if rm_type in _DATE_RM_TYPES:
+                typed[key] = rm_type
+            elif key.endswith(_CONTEXT_TIMES):
+                typed[key] = "DV_DATE_TIME"
+
+        stamps = {
+            k: c for k in typed if typed[k] != "DV_TIME"
+            for c in [_compile_date(skeleton[k], typed[k], 0)] if c
+        }
+        start = next((k for k in stamps if k.endswith(_CONTEXT_TIMES[0])), None)
+        dated = [c[0] for k, c in stamps.items() if typed[k] == "DV_DATE_TIME"]
+        self.anchor = stamps[start][0] if start else min(dated or [c[0] for c in stamps.values()] or [0])
+        day = self.anchor // 86400
+        for k in typed:
+            if typed[k] == "DV_TIME":
+                c = _compile_date(skeleton[k], "DV_TIME", day)
+                if c:
+                    stamps[k] = c
+
+        self.slots: dict[str, tuple[int, object]] = {k: (e - self.anchor, f) for k, (e, f) in stamps.items()}
+        # Per WT path: (index, offset) of the first instance and the per-index step
+        by_wt: dict[str, list[tuple[int, int, object]]] = {}
+        for k, (off, fmt) in self.slots.items():
+            m = _LAST_INDEX.search(k)
+            by_wt.setdefault(wt_path_of(k), []).append((int(m.group(1)) if m else 0, off, fmt))
+        self._by_wt: dict[str, tuple[int, int, int, object]] = {}
+        for wt, inst in by_wt.items():
+            inst.sort(key=lambda x: x[0])
+            (i0, o0, f0), (i1, o1, _) = inst[0], inst[-1]
+            self._by_wt[wt] = (i0, o0, (o1 - o0) // (i1 - i0) if i1 > i0 else 0, f0)
+
+        self.quantities: dict[str, tuple[str, Optional[float], Optional[float]]] = {}
+        for path, node in wt_index.items():
+            if node.get("rmType") == "DV_QUANTITY" and not _is_protected(path):
+                lo, hi = _input_range(node, lambda i: i.get("suffix") in (None, "", "magnitude"))
+                self.quantities[path] = (path, lo, hi)
+        self._trend_keys: dict[str, Optional[tuple[str, Optional[float], Optional[float]]]] = {}
+
+    def slot(self, key: str) -> Optional[tuple[int, object]]:
+        s = self.slots.get(key)
+        if s is None and "|" not in key:
+            entry = self._by_wt.get(wt_path_of(key))
+            if entry is not None:
+                i0, o0, step, fmt = entry
+                m = _LAST_INDEX.search(key)
+                s = self.slots[key] = (o0 + ((int(m.group(1)) if m else 0) - i0) * step, fmt)
+        return s
+
+    def trend_target(self, key: str) -> Optional[tuple[str, Optional[float], Optional[float]]]:
+        """(WT path, lo, hi) if key is a DV_QUANTITY |magnitude, else None (cached)."""
+        try:
+            return self._trend_keys[key]
+        except KeyError:
+            t = self._trend_keys[key] = (
+                self.quantities.get(wt_path_of(key)) if key.endswith("|magnitude") else None
+            )
+            return t
+
+
+class Timelines:
+    """
+    One timeline per EHR: a first composition at a random day (08:00–18:00)
+    within [start, start + span_days), then one composition every
+    cadence_days × U(0.5, 1.5), with an exponential gap (mean gap_days)
+    after a composition with probability gap_prob. With trend, DV_QUANTITY
+    magnitudes follow a per-EHR linear drift plus noise across the series.
+    """
+
+    def __init__(
+        self,
+        start: dt.date,
+        span_days: int = 365,
+        cadence_days: float = 7.0,
+        gap_prob: float = 0.05,
+        gap_days: float = 90.0,
+        trend: bool = False,
+    ) -> None:
+        self.start = _days_from_civil(start.year, start.month, start.day) * 86400
+        self.span = max(1, span_days) * 86400
+        self.cadence = cadence_days * 86400
+        self.gap_prob = gap_prob
+        self.gap = gap_days * 86400
+        self.trend = trend
+        self.clock: dict[str, int] = {}  # ehr_id -> epoch of its last composition
+        self.series: dict[str, int] = {}  # ehr_id -> compositions stamped so far
+        self.levels: dict[tuple[str, str], tuple[float, float, int]] = {}  # (ehr_id, WT path) -> (base, slope, first index)
+
+    def next_anchor(self, ehr_id: str) -> int:
+        t = self.clock.get(ehr_id)
+        if t is None:
+            day = self.start + random.randrange(0, self.span, 86400)
+            t = day + random.randint(8 * 3600, 18 * 3600)
+        else:
+            t += int(self.cadence * random.uniform(0.5, 1.5))
+            if random.random() < self.gap_prob:
+                t += int(random.expovariate(1 / self.gap)) if self.gap > 0 else 0
+        self.clock[ehr_id] = t
+        return t
+
+    def apply(self, plan: TimePlan, flat: dict, ehr_id: str) -> dict:
+        """Stamp flat (in place) at the EHR's next timeline point; trend its quantities."""
+        shift = self.next_anchor(ehr_id)
+        slot = plan.slot
+        for key in flat:
+            s = slot(key)
+            if s is not None:
+                flat[key] = s[1](shift + s[0])
+        if self.trend:
+            # One step per composition: every instance of a WT path shares its level
+            index = self.series.get(ehr_id, 0)
+            self.series[ehr_id] = index + 1
+            level: dict[str, float] = {}
+            for key, val in flat.items():
+                if isinstance(val, bool) or not isinstance(val, (int, float)):
+                    continue
+                target = plan.trend_target(key)
+                if target is None:
+                    continue
+                wt, lo, hi = target
+                lv = level.get(wt)
+                if lv is None:
+                    st = self.levels.get((ehr_id, wt))
+                    if st is None:
+                        st = self.levels[(ehr_id, wt)] = (float(val), random.gauss(0, _TREND_SLOPE_SD), index)
+                    lv = level[wt] = st[0] * (1 + st[1] * (index - st[2]))
+                v = lv * (1 + random.gauss(0, _TREND_NOISE))
+                if lo is not None:
+                    v = max(lo, v)
+                if hi is not None:
+                    v = min(hi, v)
+                flat[key] = round(v, 2) if isinstance(val, float) else round(v)
+        return flat
+
+
+# ── local output ───────────────────────────────────────────────────────────────
+
+_TRASH_PREFIX = ".compositions-old-"
+
+
+def _sweep_trash() -> None:
+    parent = os.path.dirname(DIST_DIR)
+    for name in os.listdir(parent):
+        if name.startswith(_TRASH_PREFIX):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def clear_dist() -> None:
+    """
+    Empty DIST_DIR without walking it: the old directory is renamed aside
+    (atomic on the same filesystem) and deleted by a background thread,
+    together with leftovers from runs that exited before deletion finished.
+    """
+    if os.listdir(DIST_DIR):
+        trash = os.path.join(os.path.dirname(DIST_DIR), f"{_TRASH_PREFIX}{time.time_ns()}")
+        os.rename(DIST_DIR, trash)
+        os.makedirs(DIST_DIR, exist_ok=True)
+    threading.Thread(target=_sweep_trash, name="dist-cleanup", daemon=True).start()
+
+
+def _write_file(path: str, data: str) -> None:
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class DistWriter:
+    """
+    Writes individual composition files under DIST_DIR.
+
+    layout:
+      "flat"     — dist/compositions/<out_name>
+      "hash"     — dist/compositions/<bucket>/<out_name>
+      "template" — dist/compositions/<template>/<bucket>/<out_name>
+                   (<template> is the `group` passed to write(), by default
+                   out_name minus its _NNNNNN.json counter)
+    Buckets are crc32(out_name) % fanout. Each bucket is owned by one of
+    `workers` single-thread executors, so workers fill different
+    subdirectories in parallel and never contend on one directory.
+    """
+
+    def __init__(
+        self, layout: str = "flat", fanout: int = _FANOUT, workers: int = _WRITERS
+    ) -> None:
+        self.layout = layout
+        self.fanout = max(1, fanout) if layout != "flat" else 1
+        self._width = len(f"{self.fanout - 1:x}")
+        self._pools = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"dist-writer-{i}")
+            for i in range(max(1, workers))
+        ]
+        self._made: set[str] = set()
+        if layout == "hash":
+            for b in range(self.fanout):
+                os.makedirs(os.path.join(DIST_DIR, f"{b:0{self._width}x}"), exist_ok=True)
+
+    def _place(self, out_name: str, group: Optional[str] = None) -> tuple[int, str]:
+        """(owner hash, directory) for out_name."""
+        h = zlib.crc32(out_name.encode())
+        if self.layout == "flat":
+            return h, DIST_DIR
+        bucket = h % self.fanout
+        sub = f"{bucket:0{self._width}x}"
+        if self.layout == "template":
+            d = os.path.join(DIST_DIR, group or out_name.rsplit("_", 1)[0], sub)
+            if d not in self._made:
+                os.makedirs(d, exist_ok=True)
+                self._made.add(d)
+            return bucket, d
+        return bucket, os.path.join(DIST_DIR, sub)
+
+    async def write(self, out_name: str, data: str, group: Optional[str] = None) -> None:
+        owner, d = self._place(out_name, group)
+        pool = self._pools[owner % len(self._pools)]
+        await asyncio.get_running_loop().run_in_executor(
+            pool, _write_file, os.path.join(d, out_name), data
+        )
+
+    def close(self) -> None:
+        for pool in self._pools:
+            pool.shutdown(wait=True)
+
+
 # ── EHRbase REST ───────────────────────────────────────────────────────────────
 
 async def create_ehr(session: aiohttp.ClientSession, url: str) -> str:
@@ -361,7 +1947,7 @@ async def fetch_webtemplate(
         headers={"Accept": "application/openehr.wt+json"},
     ) as r:
         if r.status != 200:
-            raise RuntimeError(f"WT fetch failed {r.status}: {await r.text()[:200]}")
+            raise RuntimeError(f"WT fetch failed {r.status}: {(await r.text())[:200]}")
         return await r.json(content_type=None)
 
 
@@ -385,19 +1971,96 @@ async def fetch_example_flat(
     raise RuntimeError("fetch_example_flat: unreachable")
 
 
+# ── request bodies ─────────────────────────────────────────────────────────────
+
+_LOCAL_HOSTS = frozenset({"localhost", "127.0.0.1", "::1"})
+
+
+def dumps_compact(obj) -> bytes:
+    """JSON-encode a request body without whitespace."""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class RequestEncoder:
+    """
+    Pre-encodes JSON request bodies off the event loop and, per server,
+    optionally sends them with Content-Encoding: gzip.
+
+    gzip is None while undetected. The first compressed POST decides it,
+    once, while other posts wait: 400/415 switches compression off for the
+    rest of the run (a 400 cannot tell gzip from bad data, and uncompressed
+    always works) and that composition is re-sent uncompressed; any other
+    answer switches it on.
+    """
+
+    def __init__(self, compress: bool = False, level: int = _GZIP_LEVEL) -> None:
+        self.gzip: Optional[bool] = None if compress else False
+        self.level = level
+        self._probe: Optional[asyncio.Lock] = None
+
+    @classmethod
+    def for_url(cls, url: str) -> "RequestEncoder":
+        """Compression pays off on remote CDRs only; loopback is CPU-bound."""
+        host = urllib.parse.urlsplit(url).hostname or ""
+        return cls(compress=host not in _LOCAL_HOSTS)
+
+    async def encode(self, obj) -> bytes:
+        return await asyncio.to_thread(dumps_compact, obj)
+
+    async def post(
+        self, session: aiohttp.ClientSession, endpoint: str, raw: bytes, headers: dict
+    ) -> aiohttp.ClientResponse:
+        """POST raw JSON bytes; caller releases the response (async with)."""
+        if self.gzip is None and len(raw) >= _GZIP_MIN_BYTES:
+            if self._probe is None:
+                self._probe = asyncio.Lock()
+            async with self._probe:
+                if self.gzip is None:
+                    return await self._detect(session, endpoint, raw, headers)
+        if self.gzip and len(raw) >= _GZIP_MIN_BYTES:
+            gz = await asyncio.to_thread(gzip.compress, raw, self.level)
+            return await session.post(
+                endpoint, data=gz, headers={**headers, "Content-Encoding": "gzip"}
+            )
+        return await session.post(endpoint, data=raw, headers=headers)
+
+    async def _detect(
+        self, session: aiohttp.ClientSession, endpoint: str, raw: bytes, headers: dict
+    ) -> aiohttp.ClientResponse:
+        gz = await asyncio.to_thread(gzip.compress, raw, self.level)
+        r = await session.post(endpoint, data=gz, headers={**headers, "Content-Encoding": "gzip"})
+        if r.status not in (400, 415):
+            self.gzip = True
+            return r
+        status = r.status
+        r.release()
+        self.gzip = False
+        r = await session.post(endpoint, data=raw, headers=headers)
+        print(f"\n  [~] First gzip request body answered {status} — sending uncompressed.")
+        return r
+
+
+_PLAIN = RequestEncoder()
+
+
 async def post_canonical(
-    session: aiohttp.ClientSession, url: str, ehr_id: str, comp: dict
+    session: aiohttp.ClientSession,
+    url: str,
+    ehr_id: str,
+    comp: dict | bytes,
+    encoder: RequestEncoder = _PLAIN,
 ) -> str:
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
         "Prefer": "return=representation",
     }
-    async with session.post(
-        f"{url}/ehr/{ehr_id}/composition", json=comp, headers=headers
+    raw = comp if isinstance(comp, bytes) else dumps_compact(comp)
+    async with await encoder.post(
+        session, f"{url}/ehr/{ehr_id}/composition", raw, headers
     ) as r:
         if r.status not in (200, 201, 204):
-            raise RuntimeError(f"POST canonical failed {r.status}: {await r.text()[:300]}")
+            raise RuntimeError(f"POST canonical failed {r.status}: {(await r.text())[:300]}")
         if r.status == 204:
             loc = r.headers.get("Location", "")
             return loc.rstrip("/").rsplit("/", 1)[-1]
@@ -415,8 +2078,9 @@ async def post_flat(
     url: str,
     ehr_id: str,
     template_id: str,
-    flat: dict,
+    flat: dict | bytes,
     prefer_repr: bool = False,
+    encoder: RequestEncoder = _PLAIN,
 ) -> tuple[int, str | dict, str]:
     """Returns (status, body, uid). uid extracted from Location header."""
     endpoint = f"{url}/ehr/{ehr_id}/composition?format=FLAT&templateId={template_id}"
@@ -425,162 +2089,451 @@ async def post_flat(
         "Accept": "application/json",
         "Prefer": "return=representation" if prefer_repr else "return=minimal",
     }
-    async with session.post(endpoint, json=flat, headers=headers) as r:
+    raw = flat if isinstance(flat, bytes) else dumps_compact(flat)
+    async with await encoder.post(session, endpoint, raw, headers) as r:
         uid = r.headers.get("Location", "").rstrip("/").rsplit("/", 1)[-1]
         if prefer_repr and r.status in (200, 201):
             return r.status, await r.json(content_type=None), uid
         return r.status, await r.text(), uid
 
 
+# ── contributions ──────────────────────────────────────────────────────────────
+
+_OPENEHR_AUDIT = {
+    "_type": "AUDIT_DETAILS",
+    "change_type": {
+        "_type": "DV_CODED_TEXT",
+        "value": "creation",
+        "defining_code": {"terminology_id": {"value": "openehr"}, "code_string": "249"},
+    },
+    "committer": {"_type": "PARTY_IDENTIFIED", "name": "openEHR Data Generator"},
+}
+
+_LIFECYCLE_COMPLETE = {
+    "_type": "DV_CODED_TEXT",
+    "value": "complete",
+    "defining_code": {"terminology_id": {"value": "openehr"}, "code_string": "532"},
+}
+
+# Pre-encoded CONTRIBUTION framing; compositions are spliced in as raw JSON bytes
+_VERSION_HEAD = dumps_compact({
+    "_type": "ORIGINAL_VERSION",
+    "commit_audit": _OPENEHR_AUDIT,
+    "lifecycle_state": _LIFECYCLE_COMPLETE,
+})[:-1] + b',"data":'
+_CONTRIBUTION_TAIL = b'],"audit":' + dumps_compact(_OPENEHR_AUDIT) + b"}"
+
+# Statuses meaning "this server does not do contributions" rather than "bad batch"
+_CONTRIBUTION_UNSUPPORTED = frozenset({404, 405, 406, 415, 501})
+
+
+async def post_contribution(
+    session: aiohttp.ClientSession,
+    url: str,
+    ehr_id: str,
+    comps: list[bytes],
+    encoder: RequestEncoder = _PLAIN,
+) -> tuple[int, str | dict]:
+    """POST pre-encoded canonical compositions as one CONTRIBUTION. Returns (status, body)."""
+    raw = b'{"versions":[' + b",".join(_VERSION_HEAD + c + b"}" for c in comps) + _CONTRIBUTION_TAIL
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Prefer": "return=representation",
+    }
+    async with await encoder.post(
+        session, f"{url}/ehr/{ehr_id}/contribution", raw, headers
+    ) as r:
+        if r.status in (200, 201):
+            return r.status, await r.json(content_type=None)
+        return r.status, await r.text()
+
+
+def contribution_version_uids(body: dict) -> list[str]:
+    """Version UIDs from a CONTRIBUTION representation, in submission order."""
+    uids = []
+    for ref in body.get("versions") or []:
+        uid = (ref.get("id") or {}).get("value") if isinstance(ref, dict) else None
+        if uid:
+            uids.append(uid)
+    return uids
+
+
+class ContributionSubmitter:
+    """
+    Batch canonical compositions for the same EHR into one contribution.
+
+    submit() buffers per EHR and posts a contribution once batch_size is
+    reached (or when the total buffered exceeds max_buffered, the fullest
+    buffer is flushed early to bound memory). flush() posts what is left.
+    Each composition is reported through on_result(tag, out_name, ehr_id,
+    uid, error) — uid is the version UID the CDR returned, error is None on
+    success.
+
+    A batch the server rejects is re-posted one composition at a time; a
+    status in _CONTRIBUTION_UNSUPPORTED, or _CONTRIBUTION_MAX_FAILURES
+    rejected batches in a row, switches the submitter to per-composition
+    posts for the rest of the run.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        on_result,
+        batch_size: int = _CONTRIBUTION_BATCH,
+        concurrency: int = 10,
+        encoder: RequestEncoder = _PLAIN,
+    ) -> None:
+        self.session = session
+        self.url = url
+        self.encoder = encoder
+        self.on_result = on_result
+        self.batch_size = max(1, batch_size)
+        self.max_buffered = self.batch_size * 4 * concurrency
+        self.supported = self.batch_size > 1
+        self.failures = 0  # consecutive rejected batches
+        self.sem = asyncio.Semaphore(concurrency)
+        self.buffers: dict[str, list[tuple[str, str, bytes]]] = {}
+        self.buffered = 0
+
+    async def submit(self, ehr_id: str, tag: str, out_name: str, comp: bytes) -> None:
+        """comp is the pre-encoded canonical JSON (see RequestEncoder.encode)."""
+        if not self.supported:
+            async with self.sem:
+                await self._post_one(ehr_id, tag, out_name, comp)
+            return
+        buf = self.buffers.setdefault(ehr_id, [])
+        buf.append((tag, out_name, comp))
+        self.buffered += 1
+        if len(buf) >= self.batch_size:
+            await self._flush(ehr_id)
+        elif self.buffered > self.max_buffered:
+            await self._flush(max(self.buffers, key=lambda e: len(self.buffers[e])))
+
+    async def flush(self) -> None:
+        await asyncio.gather(*[self._flush(ehr_id) for ehr_id in list(self.buffers)])
+
+    async def _flush(self, ehr_id: str) -> None:
+        batch = self.buffers.pop(ehr_id, None)
+        if not batch:
+            return
+        self.buffered -= len(batch)
+        async with self.sem:
+            if self.supported:
+                try:
+                    status, body = await post_contribution(
+                        self.session, self.url, ehr_id, [comp for _, _, comp in batch], self.encoder
+                    )
+                except Exception as e:
+                    status, body = 0, str(e)
+                if status in (200, 201) and isinstance(body, dict):
+                    self.failures = 0
+                    uids = contribution_version_uids(body)
+                    if len(uids) == len(batch):
+                        for (tag, out_name, _), uid in zip(batch, uids):
+                            self.on_result(tag, out_name, ehr_id, uid, None)
+                        return
+                    # Committed but unmappable — do not re-post, that would duplicate data
+                    for tag, out_name, _ in batch:
+                        self.on_result(tag, out_name, ehr_id, "", None)
+                    return
+                self.failures += 1
+                if status in _CONTRIBUTION_UNSUPPORTED and self.supported:
+                    self.supported = False
+                    print(f"\n  [~] Contributions not supported ({status}) — posting compositions individually.")
+                elif self.failures >= _CONTRIBUTION_MAX_FAILURES and self.supported:
+                    self.supported = False
+                    print(f"\n  [~] {self.failures} contributions in a row rejected ({status} {str(body)[:200]}) "
+                          f"— posting compositions individually.")
+            for tag, out_name, comp in batch:
+                await self._post_one(ehr_id, tag, out_name, comp)
+
+    async def _post_one(self, ehr_id: str, tag: str, out_name: str, comp: bytes) -> None:
+        try:
+            uid = await post_canonical(self.session, self.url, ehr_id, comp, self.encoder)
+        except Exception as e:
+            self.on_result(tag, out_name, ehr_id, "", str(e))
+            return
+        self.on_result(tag, out_name, ehr_id, uid, None)
+
+
 # ── OPT helpers ────────────────────────────────────────────────────────────────
 
 _OPT_NS = "http://schemas.openehr.org/v1"
 
-def extract_opt_template_id(xml_text: str) -> Optional[str]:
-    """Extract <template_id><value> from OPT XML (with or without namespace)."""
+def extract_opt_template_id(opt_path: str) -> Optional[str]:
+    """
+    Extract <template_id><value> from an OPT file (with or without namespace).
+    Streams the XML and stops at the first template_id, which sits in the
+    header before <definition> — the archetype tree is never parsed.
+    """
+    in_template_id = False
     try:
-        root = ET.fromstring(xml_text)
-        for tag in (f"{{{_OPT_NS}}}template_id", "template_id"):
-            elem = root.find(f"{tag}/{tag.replace('template_id', 'value')}")
-            # handle mixed ns: try both ns and bare value child
-            if elem is None:
-                parent = root.find(tag)
-                if parent is not None:
-                    elem = parent.find(f"{{{_OPT_NS}}}value") or parent.find("value")
-            if elem is not None and elem.text:
+        for event, elem in ET.iterparse(opt_path, events=("start", "end")):
+            local = elem.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if local == "template_id":
+                    in_template_id = True
+                elif local == "definition":
+                    break
+            elif local == "value" and in_template_id and elem.text:
                 return elem.text.strip()
-    except Exception:
+            elif local == "template_id":
+                in_template_id = False
+    except ET.ParseError:
         pass
     return None
 
 
-# ── mode 3: upload OPTs ────────────────────────────────────────────────────────
+def hash_opt(opt_path: str) -> str:
+    """sha256 of an OPT file, read in chunks."""
+    h = hashlib.sha256()
+    with open(opt_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-async def upload_opts(session: aiohttp.ClientSession, url: str) -> None:
-    for f in os.listdir(WT_DIR):
-        os.remove(os.path.join(WT_DIR, f))
-    opt_files = [f for f in os.listdir(OPT_DIR) if f.endswith(".opt")]
-    if not opt_files:
-        print(f"[!] No .opt files found in {OPT_DIR}")
-        return
 
-    print(f"[*] Uploading {len(opt_files)} OPT(s) ...")
-    ok = failed = skipped = 0
-    uploaded_ids: list[str] = []
+def load_setup_manifest() -> dict:
+    """Manifest of the last successful Setup: {"url": ..., "opts": {fname: entry}}."""
+    if not os.path.exists(SETUP_MANIFEST):
+        return {"url": "", "opts": {}}
+    try:
+        with open(SETUP_MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"url": "", "opts": {}}
+    manifest.setdefault("url", "")
+    manifest.setdefault("opts", {})
+    return manifest
+
+
+def save_setup_manifest(manifest: dict) -> None:
+    tmp = SETUP_MANIFEST + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, SETUP_MANIFEST)
+
+
+def _opt_is_current(entry: Optional[dict]) -> bool:
+    """True if the manifest entry's WT and skeleton are both still on disk."""
+    if not entry or not entry.get("template_id"):
+        return False
+    tid = entry["template_id"]
+    return (
+        os.path.exists(os.path.join(WT_DIR, f"{tid}.json"))
+        and os.path.exists(os.path.join(FLAT_DIR, f"{tid}.json"))
+    )
 
-    for fname in sorted(opt_files):
-        with open(os.path.join(OPT_DIR, fname), "r", encoding="utf-8") as f:
-            xml = f.read()
-        try:
-            async with session.post(
-                f"{url}/definition/template/adl1.4",
-                headers={"Content-Type": "application/xml", "Accept": "application/xml"},
-                data=xml.encode("utf-8"),
-            ) as r:
-                if r.status in (200, 201):
-                    ok += 1
-                    loc = r.headers.get("Location", "")
-                    tid = urllib.parse.unquote(loc.rstrip("/").rsplit("/", 1)[-1]) if loc else fname[:-4]
-                    uploaded_ids.append(tid)
-                    print(f"  [+] {fname} -> {tid}")
-                elif r.status == 409:
-                    skipped += 1
-                    tid = extract_opt_template_id(xml)
-                    if tid:
-                        uploaded_ids.append(tid)
-                        print(f"  [~] Already exists: {fname} -> fetching WT for {tid!r}")
-                    else:
-                        print(f"  [~] Already exists: {fname} (could not extract template_id from OPT)")
-                else:
-                    failed += 1
-                    err_body = await r.text()
-                    print(f"  [!] {fname} ({r.status}): {err_body[:200]}")
-                    print(f"      Refer to openEHR specs to fix this template.")
-                    opt_path = os.path.join(OPT_DIR, fname)
-                    answer = input(f"  Rename to {fname}_invalid to skip in future runs? [y/n]: ").strip().lower()
-                    if answer == "y":
-                        os.rename(opt_path, opt_path + "_invalid")
-                        print(f"  Renamed to {fname}_invalid.")
-        except Exception as e:
-            failed += 1
-            print(f"  [!] {fname}: {e}")
 
-    print(f"\n[*] OPTs uploaded (ok:{ok} | skipped:{skipped} | fail:{failed} | total:{len(opt_files)})")
+# ── mode 3: upload OPTs ────────────────────────────────────────────────────────
 
-    if not uploaded_ids:
-        return
+async def upload_opts(
+    session: aiohttp.ClientSession, url: str
+) -> tuple[dict, dict[str, dict], list[tuple[str, str]], list[tuple[str, str]]]:
+    """
+    Upload new or changed OPTs concurrently and fetch their webtemplates.
+
+    Each .opt is hashed; OPTs whose hash matches the manifest from the last
+    Setup against the same CDR, and whose WT and skeleton still exist, are
+    skipped entirely.
+
+    A changed OPT answered with 409 keeps its manifest entry (old hash, so
+    the mismatch is seen again on every run) plus a "conflict" marker with
+    the new hash; its previous WT and skeleton stay in place.
+
+    Returns (manifest, pending, invalid, conflicts):
+      pending   — {fname: {"sha256", "size", "mtime_ns", "template_id"}} whose WT
+                  was (re)fetched and still need a skeleton
+      invalid   — [(fname, reason)] rejected by the CDR or whose WT could not be
+                  fetched, for the end-of-run summary
+      conflicts — [(fname, template_id)] changed, but the CDR still holds the
+                  old definition under that template_id
+    """
+    manifest = load_setup_manifest()
+    if manifest["url"] != url:
+        # Different CDR — nothing can be assumed to be uploaded there
+        manifest = {"url": url, "opts": {}}
+    known: dict[str, dict] = manifest["opts"]
+
+    opt_files = sorted(f for f in os.listdir(OPT_DIR) if f.endswith(".opt"))
+    if not opt_files:
+        print(f"[!] No .opt files found in {OPT_DIR}")
+        return manifest, {}, [], []
+
+    # Forget OPTs that were removed or renamed since the last run
+    for fname in list(known):
+        if fname not in opt_files:
+            del known[fname]
+
+    stale: dict[str, dict] = {}
+    previous: dict[str, dict] = {}  # manifest entries of changed OPTs, restored on a 409
+    for fname in opt_files:
+        opt_path = os.path.join(OPT_DIR, fname)
+        st = os.stat(opt_path)
+        entry = known.get(fname)
+        # size + mtime unchanged → reuse the recorded hash instead of re-reading
+        if entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+            digest = entry["sha256"]
+        else:
+            digest = hash_opt(opt_path)
+        if entry and entry.get("sha256") == digest and _opt_is_current(entry):
+            entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
+            entry.pop("conflict", None)  # reverted to the definition the CDR holds
+            continue
+        stale[fname] = {"sha256": digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if entry and entry.get("sha256") != digest and entry.get("template_id"):
+            previous[fname] = entry
+        known.pop(fname, None)  # re-added only once WT and skeleton are both fetched
+
+    current = len(opt_files) - len(stale)
+    if not stale:
+        print(f"[*] All {len(opt_files)} OPT(s) are up to date — nothing to upload.")
+        return manifest, {}, [], []
 
-    print(f"\n[*] Fetching webtemplates for {len(uploaded_ids)} uploaded template(s) -> {WT_DIR}")
-    wt_ok = wt_fail = 0
+    print(f"[*] Uploading {len(stale)} new/changed OPT(s) ({current} up to date) ...")
+    ok = failed = skipped = 0
+    pending: dict[str, dict] = {}
+    invalid: list[tuple[str, str]] = []
+    conflicts: list[tuple[str, str]] = []
     sem = asyncio.Semaphore(10)
 
-    async def fetch_one(tid: str) -> None:
-        nonlocal wt_ok, wt_fail
+    async def upload_one(fname: str) -> None:
+        nonlocal ok, failed, skipped
+        opt_path = os.path.join(OPT_DIR, fname)
         async with sem:
             try:
+                with open(opt_path, "rb") as f:
+                    xml = f.read()
+                async with session.post(
+                    f"{url}/definition/template/adl1.4",
+                    headers={"Content-Type": "application/xml", "Accept": "application/xml"},
+                    data=xml,
+                ) as r:
+                    if r.status in (200, 201):
+                        ok += 1
+                        loc = r.headers.get("Location", "")
+                        tid = urllib.parse.unquote(loc.rstrip("/").rsplit("/", 1)[-1]) if loc else fname[:-4]
+                        print(f"  [+] {fname} -> {tid}")
+                    elif r.status == 409:
+                        tid = extract_opt_template_id(opt_path)
+                        if not tid:
+                            failed += 1
+                            print(f"  [~] Already exists: {fname} (could not extract template_id from OPT)")
+                            invalid.append((fname, "exists on CDR, template_id not found in OPT"))
+                            return
+                        if fname in previous:
+                            # The CDR keeps the old definition; its WT would not match this OPT.
+                            # Keep the old entry (and so its WT and skeleton), flagged.
+                            print(f"  [~] {fname} changed but {tid!r} already exists on the CDR — not updated")
+                            known[fname] = {**previous[fname], "conflict": stale[fname]["sha256"]}
+                            conflicts.append((fname, tid))
+                            return
+                        skipped += 1
+                        print(f"  [~] Already exists: {fname} -> fetching WT for {tid!r}")
+                    else:
+                        failed += 1
+                        err_body = await r.text()
+                        print(f"  [!] {fname} ({r.status}): {err_body[:200]}")
+                        invalid.append((fname, f"upload {r.status}"))
+                        return
                 wt = await fetch_webtemplate(session, url, tid)
                 with open(os.path.join(WT_DIR, f"{tid}.json"), "w") as f:
                     json.dump(wt, f, indent=2)
-                wt_ok += 1
+                pending[fname] = {**stale[fname], "template_id": tid}
             except Exception as e:
-                wt_fail += 1
-                print(f"  [!] WT fetch failed for {tid!r}: {e}")
+                failed += 1
+                print(f"  [!] {fname}: {e}")
+                invalid.append((fname, f"webtemplate: {e}"))
 
-    await asyncio.gather(*[fetch_one(tid) for tid in uploaded_ids])
-    print(f"[*] Webtemplates saved (success:{wt_ok} | fail:{wt_fail} | total:{len(uploaded_ids)})")
+    await asyncio.gather(*[upload_one(f) for f in stale])
+    print(f"\n[*] OPTs uploaded (ok:{ok} | skipped:{skipped} | conflict:{len(conflicts)} "
+          f"| fail:{failed} | total:{len(stale)})")
+    print(f"[*] Webtemplates saved -> {WT_DIR} (success:{len(pending)} | total:{ok + skipped})")
+    return manifest, pending, invalid, conflicts
 
 
 # ── mode 3 step 2: fetch flat skeletons ───────────────────────────────────────
 
-async def run_setup(session: aiohttp.ClientSession, url: str) -> None:
-    # ── clear stale flat skeletons ────────────────────────────────────────────
-    for f in os.listdir(FLAT_DIR):
-        os.remove(os.path.join(FLAT_DIR, f))
-
-    # ── re-fetch webtemplates ─────────────────────────────────────────────────
-    wt_files = sorted(f for f in os.listdir(WT_DIR) if f.endswith(".json"))
-    if not wt_files:
-        print("[!] No webtemplates found after upload — nothing to set up.")
-        return
+async def run_setup(
+    session: aiohttp.ClientSession,
+    url: str,
+    manifest: dict,
+    pending: dict[str, dict],
+    invalid: list[tuple[str, str]],
+    conflicts: list[tuple[str, str]] = [],
+) -> None:
+    """
+    Fetch flat skeletons for the templates refreshed by upload_opts, record
+    them in the manifest, drop artefacts no current OPT maps to, list OPTs in
+    conflict with the CDR, then ask once about every OPT that failed.
+    """
+    known: dict[str, dict] = manifest["opts"]
 
-    print(f"[*] {len(wt_files)} webtemplate(s) found. Fetching flat examples -> {FLAT_DIR}")
+    if pending:
+        print(f"[*] Fetching {len(pending)} flat example(s) -> {FLAT_DIR}")
     ok = 0
-    failures: list[tuple[str, str, str]] = []  # (fname, wt_path, tid)
     sem = asyncio.Semaphore(10)
 
-    async def one(fname: str) -> None:
+    async def one(fname: str, entry: dict) -> None:
         nonlocal ok
+        tid = entry["template_id"]
         async with sem:
-            tid: str = fname[:-5]  # fallback: strip .json
             try:
-                with open(os.path.join(WT_DIR, fname)) as f:
-                    wt = json.load(f)
-                tid = wt.get("templateId") or tid
-                if not wt.get("templateId"):
-                    raise ValueError(f"No templateId in {fname}")
                 flat = await fetch_example_flat(session, url, tid)
                 envelope = {"template_id": tid, "flat_comp": flat}
                 with open(os.path.join(FLAT_DIR, f"{tid}.json"), "w") as f:
                     json.dump(envelope, f, indent=2)
+                known[fname] = entry
                 ok += 1
             except Exception as e:
-                failures.append((fname, os.path.join(WT_DIR, fname), tid))
-                print(f"  [!] {fname}: {e}")
-
-    await asyncio.gather(*[one(f) for f in wt_files])
-    print(f"[*] Flat examples fetched (success:{ok} | fail:{len(failures)} | total:{len(wt_files)})")
+                known.pop(fname, None)
+                invalid.append((fname, f"flat example: {e}"))
+                print(f"  [!] {tid}: {e}")
+
+    await asyncio.gather(*[one(fname, entry) for fname, entry in pending.items()])
+    if pending:
+        print(f"[*] Flat examples fetched (success:{ok} | fail:{len(pending) - ok} | total:{len(pending)})")
+
+    # ── prune artefacts of templates no current OPT maps to ───────────────────
+    live = {e["template_id"] for e in known.values()}
+    live.update(e["template_id"] for e in pending.values())
+    for d in (WT_DIR, FLAT_DIR):
+        for f in os.listdir(d):
+            if f.endswith(".json") and not f.endswith(_PROFILE_SUFFIX) and f[:-5] not in live:
+                os.remove(os.path.join(d, f))
+
+    save_setup_manifest(manifest)
+    print(f"[*] Setup complete: {sum('conflict' not in e for e in known.values())} template(s) current.")
+
+    if conflicts:
+        print(f"\n[~] {len(conflicts)} OPT(s) changed, but the CDR still holds the old definition "
+              f"(their previous webtemplate and skeleton are kept):")
+        for fname, tid in sorted(conflicts):
+            print(f"  - {fname}: {tid!r} exists on the CDR — delete it there or give the OPT a new template_id")
+
+    if not invalid:
+        return
 
-    for fname, wt_path, tid in failures:
-        opt_path = os.path.join(OPT_DIR, f"{tid}.opt")
-        answer = input(f"  Mark {tid}.opt as invalid and delete its webtemplate? [y/n]: ").strip().lower()
-        if answer == "y":
-            if os.path.exists(opt_path):
-                os.rename(opt_path, opt_path + "_invalid")
-                print(f"  Renamed {tid}.opt -> {tid}.opt_invalid.")
-            else:
-                print(f"  [!] OPT not found at {opt_path} — skipping rename.")
-            os.remove(wt_path)
-            print(f"  Deleted webtemplate {fname}.")
+    # ── deferred decisions: one summary, one prompt ───────────────────────────
+    print(f"\n[!] {len(invalid)} OPT(s) failed — refer to openEHR specs to fix these templates:")
+    for fname, reason in sorted(invalid):
+        print(f"  - {fname}: {reason[:200]}")
+    answer = input(f"  Rename all {len(invalid)} to *.opt_invalid to skip in future runs? [y/n]: ").strip().lower()
+    if answer != "y":
+        return
+    for fname, _ in invalid:
+        opt_path = os.path.join(OPT_DIR, fname)
+        tid = (pending.get(fname) or {}).get("template_id")
+        if os.path.exists(opt_path):
+            os.rename(opt_path, opt_path + "_invalid")
+            print(f"  Renamed {fname} -> {fname}_invalid.")
+        if tid and tid not in {e["template_id"] for e in known.values()}:
+            wt_path = os.path.join(WT_DIR, f"{tid}.json")
+            if os.path.exists(wt_path):
+                os.remove(wt_path)
+                print(f"  Deleted webtemplate {tid}.json.")
 
 
 # ── mode 1: duplicate canonical compositions ───────────────────────────────────
@@ -592,7 +2545,20 @@ async def run_duplicate(
     url: str = "",
     ehr_pool: list[str] = [],
     packaging: str = "a",
+    batch_size: int = _CONTRIBUTION_BATCH,
+    encoder: RequestEncoder = _PLAIN,
+    layout: str = "flat",
+    fanout: int = _FANOUT,
+    scheduler: Optional[EhrScheduler] = None,
+    vary: bool = False,
+    fetch_canonical: bool = False,
 ) -> None:
+    """
+    Post or save `count` copies of every canonical composition. With
+    fetch_canonical, the version UIDs the CDR returns are mapped back to
+    output names and the stored compositions are fetched via AQL into
+    dist/compositions/ afterwards.
+    """
     comp_files = sorted(f for f in os.listdir(USER_COMPS_DIR) if f.endswith(".json"))
     if not comp_files:
         print(f"[!] No compositions in {USER_COMPS_DIR}.")
@@ -600,11 +2566,12 @@ async def run_duplicate(
 
     send_cdr   = dest == "b" and session is not None
     save_local = dest == "a"
-    if save_local:
-        for f in os.listdir(DIST_DIR):
-            os.remove(os.path.join(DIST_DIR, f))
+    fetch      = fetch_canonical and send_cdr
+    if save_local or fetch:
+        clear_dist()
     ok = failed = 0
     first_errors: dict[str, str] = {}
+    uid_records: list[tuple[str, str, str]] = []  # (out_name, ehr_id, uid)
     counters: dict[str, int] = {}
     sem = asyncio.Semaphore(10)
 
@@ -612,6 +2579,7 @@ async def run_duplicate(
         tarfile.open(os.path.join(DIST_DIR, "compositions.tar.gz"), "w:gz")
         if save_local and packaging == "b" else None
     )
+    writer = DistWriter(layout, fanout) if (save_local or fetch) and not zf else None
 
     total     = count * len(comp_files)
     tick_size = max(1, total // 10)
@@ -625,48 +2593,282 @@ async def run_duplicate(
             bar = "X" * last_tick + " " * (10 - last_tick)
             print(f"\r[{bar}]", end="", flush=True)
 
+    def _on_posted(fname: str, out_name: str, ehr_id: str, uid: str, err: Optional[str]) -> None:
+        nonlocal ok, failed
+        if err is None:
+            ok += 1
+            if fetch and uid:
+                uid_records.append((out_name, ehr_id, uid))
+        else:
+            failed += 1
+            first_errors.setdefault(fname, err)
+        _tick()
+
+    submitter = (
+        ContributionSubmitter(session, url, _on_posted, batch_size, encoder=encoder)
+        if send_cdr else None
+    )
+
     async def one(fname: str) -> None:
         nonlocal ok, failed
+        # Writes kept in flight so all DistWriter threads stay busy even with one source file
+        inflight: set[asyncio.Future] = set()
+
+        def _settle(done) -> None:
+            nonlocal ok
+            for fut in done:
+                fut.result()
+                ok += 1
+                _tick()
+
         async with sem:
+            cursor = scheduler.cursor() if scheduler and send_cdr else None
             try:
                 with open(os.path.join(USER_COMPS_DIR, fname)) as f:
-                    comp = json.load(f)
+                    clean = strip_canonical_uid(json.load(f))
+                mutator = None
+                if vary:
+                    template_id = ((clean.get("archetype_details") or {}).get("template_id") or {}).get("value", "")
+                    wt_index = load_wt_index(template_id) if template_id else None
+                    if wt_index is None:
+                        print(f"\n  [~] {fname}: no webtemplate for {template_id!r} — only quantities, counts and dates vary")
+                    profile = load_profile(template_id, wt_index) if wt_index else {}
+                    mutator = CanonicalMutator(clean, wt_index, profile)
+                # Without variation every copy is identical: encode the request body once per file
+                body = await encoder.encode(clean) if send_cdr and not mutator else b""
                 for _ in range(count):
-                    clean = strip_canonical_uid(copy.deepcopy(comp))
+                    n = counters.get(fname, 0)
+                    counters[fname] = n + 1
+                    out_name = f"{fname[:-5]}_{n:06d}.json"
+                    variant = mutator.apply() if mutator else clean
                     if send_cdr:
-                        await post_canonical(session, url, random.choice(ehr_pool), clean)
+                        ehr_id = await cursor.next() if cursor else random.choice(ehr_pool)
+                        if mutator:
+                            body = await encoder.encode(variant)
+                        await submitter.submit(ehr_id, fname, out_name, body)
+                        continue  # counted by _on_posted
                     if save_local:
-                        n = counters.get(fname, 0)
-                        counters[fname] = n + 1
-                        out_name = f"{fname[:-5]}_{n:06d}.json"
-                        data = json.dumps(clean, indent=2)
-                        if zf:
-                            buf = data.encode()
-                            ti = tarfile.TarInfo(name=out_name)
-                            ti.size = len(buf)
-                            zf.addfile(ti, io.BytesIO(buf))
-                        else:
-                            with open(os.path.join(DIST_DIR, out_name), "w") as f2:
-                                f2.write(data)
+                        data = json.dumps(variant, indent=2)
+                        if not zf:
+                            inflight.add(asyncio.ensure_future(writer.write(out_name, data, fname[:-5])))
+                            if len(inflight) >= 2 * _WRITERS:
+                                done, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                                _settle(done)
+                            continue  # counted by _settle
+                        buf = data.encode()
+                        ti = tarfile.TarInfo(name=out_name)
+                        ti.size = len(buf)
+                        zf.addfile(ti, io.BytesIO(buf))
                     ok += 1
                     _tick()
+                if inflight:
+                    await asyncio.wait(inflight)
+                    done, inflight = inflight, set()
+                    _settle(done)
             except Exception as e:
                 failed += 1
                 if fname not in first_errors:
                     first_errors[fname] = str(e)
                 _tick()
+            finally:
+                if inflight:
+                    await asyncio.gather(*inflight, return_exceptions=True)
+                if cursor:
+                    cursor.close()
 
     if total > 0:
         print("[          ]", end="", flush=True)
     try:
         await asyncio.gather(*[one(f) for f in comp_files])
+        if submitter:
+            await submitter.flush()
         print(f"\r[XXXXXXXXXX] {ok + failed:,} done")
+        print(f"[*] OK: {ok} | Failed: {failed}")
+        for fname, err in first_errors.items():
+            print(f"  [!] {fname}: {err}")
+        if scheduler and send_cdr:
+            print(scheduler.summary())
+        if fetch:
+            if ok > len(uid_records):
+                print(f"  [~] {ok - len(uid_records):,} posted composition(s) returned no version UID — not fetched")
+            await fetch_canonical_aql(session, url, uid_records, zf, writer)
     finally:
         if zf:
             zf.close()
-    print(f"[*] OK: {ok} | Failed: {failed}")
-    for fname, err in first_errors.items():
-        print(f"  [!] {fname}: {err}")
+        if writer:
+            writer.close()
+
+
+# ── workload mix ───────────────────────────────────────────────────────────────
+
+def load_workload() -> Optional[dict]:
+    """source_models/workload.json, or None if absent."""
+    if not os.path.exists(WORKLOAD_FILE):
+        return None
+    with open(WORKLOAD_FILE) as f:
+        return json.load(f)
+
+
+def plan_workload(spec: dict, flat_files: list[str], total: int) -> dict[str, int]:
+    """
+    Compositions per skeleton file for a workload spec:
+      {"<template_id or skeleton name>": weight,
+       "<template_id or skeleton name>": {"count": n},
+       "*": weight}                      # unlisted templates (default 0)
+    Absolute counts come first; the rest of `total` is split by weight with
+    largest-remainder rounding. Skeletons of one template share its entry.
+    """
+    groups: dict[str, list[str]] = {}  # spec key -> skeleton files it covers
+    for fname in flat_files:
+        with open(os.path.join(FLAT_DIR, fname)) as f:
+            template_id = json.load(f).get("template_id") or ""
+        key = next((k for k in (fname[:-5], template_id) if k in spec), "*")
+        groups.setdefault(key, []).append(fname)
+    for key in spec:
+        if key != "*" and key not in groups:
+            print(f"  [~] Workload: no skeleton for {key!r} — ignored")
+
+    targets: dict[str, int] = {}
+    weights: dict[str, float] = {}
+    for key, files in groups.items():
+        e, k = spec.get(key, 0), len(files)
+        if isinstance(e, dict):
+            n = int(e.get("count", 0))
+            for i, fname in enumerate(files):
+                targets[fname] = n // k + (i < n % k)
+        elif float(e) > 0:
+            # "*" weighs every unlisted skeleton; a named entry is shared by its skeletons
+            for fname in files:
+                weights[fname] = float(e) if key == "*" else float(e) / k
+
+    left = max(0, total - sum(targets.values()))
+    wsum = sum(weights.values())
+    if wsum and left:
+        exact = {f: left * w / wsum for f, w in weights.items()}
+        alloc = {f: int(x) for f, x in exact.items()}
+        for f in sorted(exact, key=lambda f: exact[f] - alloc[f], reverse=True)[: left - sum(alloc.values())]:
+            alloc[f] += 1
+        targets.update(alloc)
+    return {f: n for f, n in targets.items() if n > 0}
+
+
+class WorkloadMixer:
+    """
+    Interleaves skeletons in proportion to their targets. The next slot goes
+    to the skeleton furthest behind its share, i.e. with the smallest
+    (issued + 1) / target, so all of them progress — and finish — together
+    instead of the heaviest one setting the tail of the run.
+    """
+
+    def __init__(self, targets: dict[str, int]) -> None:
+        self.targets = {k: n for k, n in targets.items() if n > 0}
+        self.issued = dict.fromkeys(self.targets, 0)
+        self.dropped: set[str] = set()
+        self.heap = [(1 / n, k) for k, n in self.targets.items()]
+        heapq.heapify(self.heap)
+
+    def next(self) -> Optional[str]:
+        while self.heap:
+            _, name = heapq.heappop(self.heap)
+            if name in self.dropped:
+                continue
+            n = self.issued[name] = self.issued[name] + 1
+            if n < self.targets[name]:
+                heapq.heappush(self.heap, ((n + 1) / self.targets[name], name))
+            return name
+        return None
+
+    def drop(self, name: str) -> int:
+        """Stop issuing name; returns how many of its slots were never issued (0 if dropped already)."""
+        if name in self.dropped:
+            return 0
+        self.dropped.add(name)
+        return self.targets[name] - self.issued[name]
+
+
+# ── mode 2 pipeline ───────────────────────────────────────────────────────────
+
+class SkeletonGenerator:
+    """
+    Per-skeleton generation pipeline: expand repeating nodes → mutate →
+    validate/repair → (optionally) regenerate duplicates. Everything that
+    depends only on the template is compiled once in __init__.
+    """
+
+    def __init__(
+        self,
+        fname: str,
+        max_repeat: int = 0,
+        validate: bool = True,
+        guard: Optional[UniquenessGuard] = None,
+        node_failures: Optional[dict[tuple[str, str], int]] = None,
+        longitudinal: bool = False,
+    ) -> None:
+        with open(os.path.join(FLAT_DIR, fname)) as f:
+            envelope = json.load(f)
+
+        template_id = envelope.get("template_id")
+        skeleton = envelope.get("flat_comp")
+        if not template_id or not skeleton:
+            raise ValueError("Missing template_id or flat_comp in envelope")
+
+        wt_index = load_wt_index(template_id)
+        if wt_index is None:
+            raise ValueError(f"No webtemplate found for {template_id}")
+
+        self.fname = fname
+        self.template_id = template_id
+        self.wt_index = wt_index
+        self.profile = load_profile(template_id, wt_index)
+        self.stripped = strip_flat_uid(skeleton)
+        # Longitudinal runs stamp dates from the EHR's timeline instead of jittering them
+        self.time_plan = TimePlan(self.stripped, wt_index) if longitudinal else None
+        self.mutator = Mutator(
+            wt_index, self.profile, _DATE_RM_TYPES if longitudinal else frozenset()
+        )
+        self.plan = compile_expansion(self.stripped, wt_index, max_repeat)
+        self.validator = FlatValidator(wt_index, self.stripped) if validate else None
+        self.guard = guard
+        self.node_failures = node_failures if node_failures is not None else {}
+        self.repaired = self.rejected = 0
+        self._batch: list[dict] = []
+
+    def _candidate(self) -> Optional[dict]:
+        """One mutated, validated composition; None if rejected."""
+        if self.plan:
+            source = expand_flat(self.plan, self.stripped)
+            flat = self.mutator.mutate(source)
+        else:
+            # Fixed shape: every composition shares the keys, so mutate in batches
+            source = self.stripped
+            if not self._batch:
+                self._batch = self.mutator.mutate_batch(source, _MUTATE_BATCH)
+            flat = self._batch.pop()
+        if self.validator:
+            problems = self.validator.check(flat)
+            if problems:
+                for _, wt, rule in problems:
+                    self.node_failures[(wt, rule)] = self.node_failures.get((wt, rule), 0) + 1
+                problems = self.validator.check(self.validator.repair(flat, source, problems))
+                if problems:
+                    self.rejected += 1
+                    return None
+                self.repaired += 1
+        return flat
+
+    def next(self) -> Optional[dict]:
+        flat = self._candidate()
+        guard = self.guard
+        if guard:
+            tries = 0
+            while flat is not None and guard.seen(flat, self.wt_index):
+                if tries == _UNIQUE_RETRIES:
+                    guard.duplicates += 1
+                    break
+                tries += 1
+                guard.regenerated += 1
+                flat = self._candidate()
+        return flat
 
 
 # ── mode 2: jitter flat compositions ──────────────────────────────────────────
@@ -679,31 +2881,52 @@ async def run_generate(
     ehr_pool: list[str] = [],
     fmt: str = "a",
     packaging: str = "a",
+    encoder: RequestEncoder = _PLAIN,
+    layout: str = "flat",
+    fanout: int = _FANOUT,
+    max_repeat: int = 0,
+    validate: bool = True,
+    unique: bool = False,
+    scheduler: Optional[EhrScheduler] = None,
+    timelines: Optional[Timelines] = None,
+    targets: Optional[dict[str, int]] = None,
 ) -> None:
+    """
+    Generate `count` compositions per skeleton, or `targets` per skeleton
+    file (see plan_workload). Writers take their next skeleton from a
+    WorkloadMixer, so skeletons are interleaved by share, not run one by one.
+    """
     flat_files = sorted(f for f in os.listdir(FLAT_DIR) if f.endswith(".json"))
     if not flat_files:
         print("[!] No example skeleton compositions are found; run Setup (mode 3) first.")
         return
+    if targets is None:
+        targets = dict.fromkeys(flat_files, count)
 
     canonical  = fmt == "b"
     send_cdr   = (dest == "b" or canonical) and session is not None
     save_local = dest == "a"
 
     if save_local:
-        for f in os.listdir(DIST_DIR):
-            os.remove(os.path.join(DIST_DIR, f))
+        clear_dist()
     ok = failed = 0
     first_errors: dict[str, str] = {}
     counters: dict[str, int] = {}
     uid_records: list[tuple[str, str, str]] = []  # (out_name, ehr_id, uid)
-    sem = asyncio.Semaphore(10)
+    node_failures: dict[tuple[str, str], int] = {}  # (WT path, rule) -> count
+    generators: dict[str, SkeletonGenerator] = {}
+    mixer = WorkloadMixer(targets)
+    # fname -> [ok, failed, first start, last finish] (monotonic seconds)
+    per_template: dict[str, list[float]] = {}
+    guard = UniquenessGuard(sum(mixer.targets.values())) if unique else None
 
     zf = (
         tarfile.open(os.path.join(DIST_DIR, "compositions.tar.gz"), "w:gz")
         if save_local and packaging == "b" else None
     )
+    writer = DistWriter(layout, fanout) if save_local and not zf else None
 
-    total     = count * len(flat_files)
+    total     = sum(mixer.targets.values())
     tick_size = max(1, total // 10)
     last_tick = 0
 
@@ -715,33 +2938,48 @@ async def run_generate(
             bar = "X" * last_tick + " " * (10 - last_tick)
             print(f"\r[{bar}]", end="", flush=True)
 
-    async def one(fname: str) -> None:
+    def _done(fname: str, n_ok: int, n_failed: int) -> None:
         nonlocal ok, failed
-        async with sem:
-            try:
-                with open(os.path.join(FLAT_DIR, fname)) as f:
-                    envelope = json.load(f)
-
-                template_id = envelope.get("template_id")
-                skeleton = envelope.get("flat_comp")
-                if not template_id or not skeleton:
-                    raise ValueError("Missing template_id or flat_comp in envelope")
-
-                wt_index = load_wt_index(template_id)
-                if wt_index is None:
-                    raise ValueError(f"No webtemplate found for {template_id}")
-
-                stripped = strip_flat_uid(skeleton)
-                for _ in range(count):
-                    flat = copy.deepcopy(stripped)
-                    flat = mutate_flat(flat, wt_index)
-                    ehr_id = random.choice(ehr_pool) if ehr_pool else ""
+        ok += n_ok
+        failed += n_failed
+        stats = per_template[fname]
+        stats[0] += n_ok
+        stats[1] += n_failed
+        stats[3] = time.monotonic()
+        _tick()
+
+    async def worker() -> None:
+        cursor = scheduler.cursor() if scheduler and (send_cdr or timelines) else None
+        try:
+            while (fname := mixer.next()) is not None:
+                per_template.setdefault(fname, [0, 0, time.monotonic(), 0.0])
+                gen = generators.get(fname)
+                try:
+                    if gen is None:
+                        gen = generators[fname] = SkeletonGenerator(
+                            fname, max_repeat, validate, guard, node_failures, timelines is not None
+                        )
+                    flat = gen.next()
+                    if flat is None:
+                        _done(fname, 0, 1)
+                        continue
+                    if cursor:
+                        ehr_id = await cursor.next()
+                    else:
+                        ehr_id = random.choice(ehr_pool) if ehr_pool else ""
+                    if timelines:
+                        timelines.apply(gen.time_plan, flat, ehr_id)
                     n = counters.get(fname, 0)
                     counters[fname] = n + 1
-                    out_name = f"{fname[:-5]}_{n:06d}.json"
+                    if timelines and not send_cdr:
+                        # Local series: the (virtual) patient goes into the name
+                        out_name = f"{fname[:-5]}_{ehr_id}_{n:06d}.json"
+                    else:
+                        out_name = f"{fname[:-5]}_{n:06d}.json"
                     if send_cdr:
+                        body = await encoder.encode(flat)
                         status, response, uid = await post_flat(
-                            session, url, ehr_id, template_id, flat
+                            session, url, ehr_id, gen.template_id, body, encoder=encoder
                         )
                         if status not in (200, 201, 204):
                             raise RuntimeError(f"{status} {str(response)[:600]}")
@@ -755,34 +2993,56 @@ async def run_generate(
                             ti.size = len(buf)
                             zf.addfile(ti, io.BytesIO(buf))
                         else:
-                            with open(os.path.join(DIST_DIR, out_name), "w") as f2:
-                                f2.write(data)
-                    ok += 1
-                    _tick()
-            except Exception as e:
-                failed += 1
-                if fname not in first_errors:
-                    first_errors[fname] = str(e)
-                _tick()
+                            await writer.write(out_name, data, fname[:-5])
+                    _done(fname, 1, 0)
+                except Exception as e:
+                    # A broken skeleton or a rejected POST stops that skeleton. Its
+                    # unissued slots count as failed too, so OK + failed == total
+                    if fname not in first_errors:
+                        first_errors[fname] = str(e)
+                    _done(fname, 0, 1 + mixer.drop(fname))
+        finally:
+            if cursor:
+                cursor.close()
 
     if total > 0:
         print(f"[*] Posting {total:,} compositions ...")
         print("[          ]", end="", flush=True)
     try:
         t0 = time.monotonic()
-        await asyncio.gather(*[one(f) for f in flat_files])
+        await asyncio.gather(*[worker() for _ in range(min(_GENERATE_WORKERS, total) or 1)])
         print(f"\r[XXXXXXXXXX] {ok + failed:,} done")
         print(f"[*] OK: {ok} | Failed: {failed}")
         for fname, err in first_errors.items():
             print(f"  [!] {fname}: {err}")
+        if len(per_template) > 1:
+            print("[*] Per skeleton:")
+            for fname, (n_ok, n_failed, first, last) in sorted(per_template.items()):
+                span = last - first
+                rate = f"{n_ok / span:,.1f}/s" if span > 0 else "—"
+                print(f"  {fname[:-5][:40]:<40} {n_ok:>8,} ok {int(n_failed):>6,} failed "
+                      f"{n_ok / max(1, ok):>7.1%} {rate:>10} {_fmt_duration(span):>8}")
+        if node_failures:
+            repaired = sum(g.repaired for g in generators.values())
+            rejected = sum(g.rejected for g in generators.values())
+            print(f"[*] Local validation: repaired {repaired} | rejected {rejected} (not posted)")
+            ranked = sorted(node_failures.items(), key=lambda kv: -kv[1])
+            for (wt, rule), n in ranked[:10]:
+                print(f"  [~] {n:>8,}  {rule:<12} {wt}")
+        if guard:
+            print(guard.report())
+        if scheduler and (send_cdr or timelines):
+            print(scheduler.summary())
         _elapsed = int(time.monotonic() - t0)
         _mins, _secs = divmod(_elapsed, 60)
         print(f"[*] Time: {_mins}m {_secs}s" if _mins else f"[*] Time: {_secs}s")
         if canonical and uid_records:
-            await fetch_canonical_aql(session, url, uid_records, zf)
+            await fetch_canonical_aql(session, url, uid_records, zf, writer)
     finally:
         if zf:
             zf.close()
+        if writer:
+            writer.close()
 
 
 # ── canonical fetch via AQL ────────────────────────────────────────────────────
@@ -792,6 +3052,7 @@ async def fetch_canonical_aql(
     url: str,
     uid_records: list[tuple[str, str, str]],
     zf: Optional[tarfile.TarFile],
+    writer: Optional[DistWriter],
 ) -> None:
     """Fetch canonical compositions per EHR via AQL and save to disk."""
     if not uid_records:
@@ -843,7 +3104,7 @@ async def fetch_canonical_aql(
                         headers={"Content-Type": "application/json", "Accept": "application/json"},
                     ) as r:
                         if r.status != 200:
-                            raise RuntimeError(f"AQL {r.status}: {await r.text()[:200]}")
+                            raise RuntimeError(f"AQL {r.status}: {(await r.text())[:200]}")
                         rows = (await r.json(content_type=None)).get("rows", [])
                         for row in rows:
                             comp = row[0] if row else None
@@ -862,8 +3123,7 @@ async def fetch_canonical_aql(
                                 ti.size = len(buf)
                                 zf.addfile(ti, io.BytesIO(buf))
                             else:
-                                with open(os.path.join(DIST_DIR, out_name), "w") as f:
-                                    f.write(data)
+                                await writer.write(out_name, data)
                             ehr_ok += 1
                             ok += 1
                             _tick()
@@ -892,6 +3152,657 @@ async def fetch_canonical_aql(
     print(f"[*] Time: {_mins}m {_secs}s" if _mins else f"[*] Time: {_secs}s")
 
 
+# ── mode 4: capacity planning (dry run) ───────────────────────────────────────
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if n < 1024 or unit == "TB":
+            return f"{n:,.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+    return f"{n:,.1f} TB"
+
+
+def _fmt_duration(s: float) -> str:
+    s = int(round(s))
+    h, rem = divmod(s, 3600)
+    m, s = divmod(rem, 60)
+    if h:
+        return f"{h}h {m}m"
+    return f"{m}m {s}s" if m else f"{s}s"
+
+
+async def run_plan(
+    count: int,
+    max_repeat: int = 0,
+    unique: bool = False,
+    session: Optional[aiohttp.ClientSession] = None,
+    url: str = "",
+    samples: int = _PLAN_SAMPLES,
+    targets: Optional[dict[str, int]] = None,
+    ehr_spec: Optional[tuple] = None,
+) -> None:
+    """
+    Project wall time, output bytes, EHR pool and peak memory of a Mode 2 run
+    of `count` compositions per skeleton, or `targets` per skeleton file (see
+    plan_workload), from a timed sample per skeleton. With a session,
+    _PLAN_PROBES real post_flat calls per skeleton measure CDR latency (these
+    compositions are stored in the CDR). The run is modelled with Mode 2's
+    _GENERATE_WORKERS writers; ehr_spec is the per-EHR distribution, if any.
+    """
+    concurrency = _GENERATE_WORKERS
+    flat_files = sorted(f for f in os.listdir(FLAT_DIR) if f.endswith(".json"))
+    if not flat_files:
+        print("[!] No example skeleton compositions are found; run Setup (mode 3) first.")
+        return
+    per = "workload mix" if targets is not None else f"{count:,} per skeleton"
+    if targets is None:
+        targets = dict.fromkeys(flat_files, count)
+    flat_files = [f for f in flat_files if targets.get(f, 0) > 0]
+
+    total = sum(targets.get(f, 0) for f in flat_files)
+    text_model()  # build/load once so the first skeleton's timing excludes it
+    probe_ehr = await create_ehr(session, url) if session else ""
+    rows = []
+    print(f"[*] Sampling {samples} composition(s) from each of {len(flat_files)} skeleton(s) ...")
+    for fname in flat_files:
+        try:
+            t = time.perf_counter()
+            gen = SkeletonGenerator(
+                fname, max_repeat, guard=UniquenessGuard(samples) if unique else None
+            )
+            compile_s = time.perf_counter() - t
+            t = time.perf_counter()
+            flats = [f for f in (gen.next() for _ in range(samples)) if f is not None]
+            gen_s = (time.perf_counter() - t) / samples
+
+            # Separate pass: tracemalloc would distort the timings above
+            tracemalloc.start()
+            traced = SkeletonGenerator(fname, max_repeat)
+            for _ in range(min(samples, 5)):
+                traced.next()
+            _, heap_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del traced
+            if not flats:
+                raise ValueError("every sampled composition was rejected by local validation")
+
+            t = time.perf_counter()
+            pretty = [json.dumps(f, indent=2).encode() for f in flats]
+            pretty_s = (time.perf_counter() - t) / len(flats)
+            t = time.perf_counter()
+            compact = [dumps_compact(f) for f in flats]
+            compact_s = (time.perf_counter() - t) / len(flats)
+            t = time.perf_counter()
+            gz_ratio = len(gzip.compress(b"".join(pretty), 9)) / sum(map(len, pretty))
+            gz_s = (time.perf_counter() - t) / len(flats)
+
+            latency = None
+            if session:
+                lat = []
+                for f in compact[:_PLAN_PROBES]:
+                    t = time.perf_counter()
+                    status, response, _ = await post_flat(session, url, probe_ehr, gen.template_id, f)
+                    if status not in (200, 201, 204):
+                        raise RuntimeError(f"probe POST {status} {str(response)[:200]}")
+                    lat.append(time.perf_counter() - t)
+                latency = statistics.median(lat)
+
+            rows.append({
+                "name": fname[:-5], "count": targets[fname], "compile": compile_s, "gen": gen_s,
+                "pretty": pretty_s, "compact": compact_s, "gz": gz_s, "ratio": gz_ratio,
+                "raw": sum(map(len, pretty)) / len(pretty),
+                "wire": sum(map(len, compact)) / len(compact),
+                "heap": heap_peak, "latency": latency,
+                "rejected": gen.rejected / samples,
+            })
+        except Exception as e:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            print(f"  [!] {fname}: {e}")
+
+    if not rows:
+        return
+
+    print(f"\n  {'skeleton':<40} {'gen/comp':>9} {'file':>10} {'gz':>6} {'post':>8}")
+    for r in rows:
+        post = f"{r['latency'] * 1000:.0f} ms" if r["latency"] is not None else "—"
+        print(
+            f"  {r['name'][:40]:<40} {r['gen'] * 1000:>6.2f} ms {_fmt_bytes(r['raw']):>10} "
+            f"{r['ratio']:>6.1%} {post:>8}"
+        )
+
+    # The event loop is single-threaded: CPU work per composition is serial,
+    # CDR latency overlaps across `concurrency` in-flight requests.
+    setup_s = sum(r["compile"] for r in rows)
+    cpu_local = setup_s + sum(r["count"] * (r["gen"] + r["pretty"]) for r in rows)
+    cpu_tar = cpu_local + sum(r["count"] * r["gz"] for r in rows)
+    raw_bytes = sum(r["count"] * r["raw"] for r in rows)
+    tar_bytes = sum(r["count"] * r["raw"] * r["ratio"] for r in rows)
+    ehr_pool = len(plan_ehr_quotas(total, ehr_spec)) if ehr_spec else max(1, total // 100)
+
+    # run_generate keeps every skeleton's compiled generator alive until the end
+    peak = sum(r["heap"] for r in rows) + concurrency * max(r["wire"] for r in rows) * 2
+    if unique:
+        peak += BloomFilter(total).m / 8
+
+    print(f"\n[*] Projection for {total:,} compositions ({per}, concurrency {concurrency}):")
+    print(f"  Local, individual files : {_fmt_duration(cpu_local):>10}   {_fmt_bytes(raw_bytes)}")
+    print(f"  Local, tar.gz           : {_fmt_duration(cpu_tar):>10}   {_fmt_bytes(tar_bytes)}")
+    if all(r["latency"] is not None for r in rows):
+        cpu_cdr = setup_s + sum(r["count"] * (r["gen"] + r["compact"]) for r in rows)
+        net_cdr = sum(r["count"] * r["latency"] for r in rows) / concurrency
+        bound = "CDR-bound" if net_cdr > cpu_cdr else "CPU-bound"
+        wire = sum(r["count"] * r["wire"] for r in rows)
+        print(f"  Send to CDR             : {_fmt_duration(max(cpu_cdr, net_cdr)):>10}   "
+              f"{_fmt_bytes(wire)} request bodies ({bound})")
+        # canonical fetch keeps one (out_name, ehr_id, uid) record per composition
+        canon_peak = peak + total * 250
+        print(f"  Peak memory (est.)      : {_fmt_bytes(peak)} flat / {_fmt_bytes(canon_peak)} with canonical fetch")
+    else:
+        print("  Send to CDR             : not probed")
+        print(f"  Peak memory (est.)      : {_fmt_bytes(peak)}")
+    print(f"  EHR pool                : {ehr_pool:,}")
+
+    rejected = [r for r in rows if r["rejected"]]
+    for r in rejected:
+        print(f"  [~] {r['name']}: {r['rejected']:.1%} of samples rejected by local validation")
+
+    free = shutil.disk_usage(os.path.dirname(DIST_DIR) or ".").free
+    if raw_bytes > free:
+        print(f"  [!] Individual files need {_fmt_bytes(raw_bytes)} but only {_fmt_bytes(free)} is free "
+              f"— use tar.gz" + (" (also too large)" if tar_bytes > free else ""))
+    else:
+        print(f"  Disk free               : {_fmt_bytes(free)}")
+
+
+# ── mode 4: mutation cost profile ─────────────────────────────────────────────
+
+def _frame(s: str) -> str:
+    """A collapsed-stack frame: no ';' (frame separator) or spaces (count separator)."""
+    return s.replace(";", "_").replace(" ", "_") or "_"
+
+
+class MutationProfile:
+    """
+    Where one skeleton's mutation and serialization time goes, per WT node.
+
+    Each sample runs Mutator.mutate's steps one node (flat base path) at a
+    time under perf_counter_ns: handler compile (first use), handler.mutate,
+    the null_flavour injection. json.dumps (file) and dumps_compact (wire) of
+    the whole composition are timed once and shared out by each node's
+    encoded bytes — encoding time is linear in them. A second pass under
+    tracemalloc, kept apart so it does not distort the timings, records the
+    bytes each handler call leaves allocated and its transient peak.
+    Per-node timer overhead is included; `mutate_ms` is the plain call.
+    """
+
+    def __init__(self, gen: SkeletonGenerator) -> None:
+        self.gen = gen
+        self.name = gen.fname[:-5]
+        self.nodes: dict[str, dict] = {}  # WT path -> counters
+        self.samples = self.traced = self.keys = 0
+        self.mutate_ns = self.copy_ns = self.pretty_ns = self.compact_ns = 0
+        self.copy_bytes = self.serialize_peak = 0
+        self._compiled: set[str] = set()
+
+    def _node(self, base: str) -> dict:
+        wt_path = wt_path_of(base)
+        st = self.nodes.get(wt_path)
+        if st is None:
+            wt_node = self.gen.wt_index.get(wt_path) or {}
+            if _is_protected(base):
+                rm_type = "(protected)"
+            else:
+                rm_type = wt_node.get("rmType") or "(not in WT)"
+            st = self.nodes[wt_path] = {
+                "rm_type": rm_type, "handler": None, "instances": 0, "keys": 0,
+                "compile_ns": 0, "mutate_ns": 0, "null_flavour_ns": 0, "serialize_ns": 0.0,
+                "alloc_bytes": 0, "peak_bytes": 0,
+            }
+        return st
+
+    def _source(self) -> dict:
+        gen = self.gen
+        return expand_flat(gen.plan, gen.stripped) if gen.plan else gen.stripped
+
+    def sample(self) -> None:
+        m, pc = self.gen.mutator, time.perf_counter_ns
+        source = self._source()
+        t = pc()
+        out = dict(source)
+        groups = m._groups(source)
+        self.copy_ns += pc() - t
+        for base, keys in groups.items():
+            st = self._node(base)
+            if base not in self._compiled:
+                self._compiled.add(base)
+                t = pc()
+                h = m.handler(base)
+                st["compile_ns"] += pc() - t
+            else:
+                h = m.handler(base)
+            st["instances"] += 1
+            if h is not None:
+                st["handler"] = type(h).__name__
+                t = pc()
+                h.mutate(out, keys)
+                st["mutate_ns"] += pc() - t
+            t = pc()
+            m._inject_null_flavours(out, (base,))
+            st["null_flavour_ns"] += pc() - t
+
+        t = pc()
+        json.dumps(out, indent=2)
+        pretty = pc() - t
+        t = pc()
+        dumps_compact(out)
+        compact = pc() - t
+        self.pretty_ns += pretty
+        self.compact_ns += compact
+
+        # Compact encoding of a key is '"key":value,' — its share of the document
+        sizes: dict[str, int] = {}
+        for base, keys in m._groups(out).items():
+            sizes[base] = sum(len(json.dumps(k)) + len(json.dumps(out[k])) + 2 for k in keys)
+            self._node(base)["keys"] += len(keys)
+        whole = sum(sizes.values()) or 1
+        for base, n in sizes.items():
+            self._node(base)["serialize_ns"] += (pretty + compact) * n / whole
+        self.keys += len(out)
+        self.samples += 1
+        # Uninstrumented reference, after the first sample has compiled the handlers
+        t = pc()
+        m.mutate(source)
+        self.mutate_ns += pc() - t
+
+    def sample_traced(self) -> None:
+        """Allocation pass; call with tracemalloc tracing."""
+        m = self.gen.mutator
+        source = self._source()
+        before = tracemalloc.get_traced_memory()[0]
+        out = dict(source)
+        groups = m._groups(source)
+        self.copy_bytes += tracemalloc.get_traced_memory()[0] - before
+        for base, keys in groups.items():
+            h = m.handler(base)
+            if h is None:
+                continue
+            st = self._node(base)
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            h.mutate(out, keys)
+            current, peak = tracemalloc.get_traced_memory()
+            st["alloc_bytes"] += current - before
+            st["peak_bytes"] = max(st["peak_bytes"], peak - before)
+        m._inject_null_flavours(out, groups)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        json.dumps(out, indent=2)
+        self.serialize_peak = max(self.serialize_peak, tracemalloc.get_traced_memory()[1] - before)
+        self.traced += 1
+
+    def report(self) -> dict:
+        n, nt = max(1, self.samples), max(1, self.traced)
+        rows = []
+        for wt_path, st in self.nodes.items():
+            ns = st["mutate_ns"] + st["null_flavour_ns"] + st["serialize_ns"]
+            rows.append({
+                "wt_path": wt_path, "rm_type": st["rm_type"], "handler": st["handler"],
+                "instances": st["instances"] / n, "keys": st["keys"] / n,
+                "total_us": ns / n / 1000, "mutate_us": st["mutate_ns"] / n / 1000,
+                "null_flavour_us": st["null_flavour_ns"] / n / 1000,
+                "serialize_us": st["serialize_ns"] / n / 1000,
+                "alloc_bytes": st["alloc_bytes"] / nt, "peak_bytes": st["peak_bytes"],
+                "compile_us": st["compile_ns"] / 1000,
+            })
+        rows.sort(key=lambda r: -r["total_us"])
+        whole = sum(r["total_us"] for r in rows) or 1
+        by_type: dict[str, dict] = {}
+        for r in rows:
+            r["share"] = r["total_us"] / whole
+            agg = by_type.setdefault(r["rm_type"], {
+                "rm_type": r["rm_type"], "nodes": 0, "keys": 0.0, "total_us": 0.0,
+                "mutate_us": 0.0, "null_flavour_us": 0.0, "serialize_us": 0.0, "alloc_bytes": 0.0,
+            })
+            agg["nodes"] += 1
+            for k in ("keys", "total_us", "mutate_us", "null_flavour_us", "serialize_us", "alloc_bytes"):
+                agg[k] += r[k]
+        rm_types = sorted(by_type.values(), key=lambda a: -a["total_us"])
+        for agg in rm_types:
+            agg["share"] = agg["total_us"] / whole
+        return {
+            "skeleton": self.name, "template_id": self.gen.template_id,
+            "samples": self.samples, "traced_samples": self.traced,
+            "keys_per_composition": self.keys / n,
+            "per_composition": {
+                "mutate_ms": self.mutate_ns / n / 1e6,
+                "copy_and_group_ms": self.copy_ns / n / 1e6,
+                "serialize_pretty_ms": self.pretty_ns / n / 1e6,
+                "serialize_compact_ms": self.compact_ns / n / 1e6,
+                "copy_bytes": self.copy_bytes / nt,
+                "serialize_peak_bytes": self.serialize_peak,
+            },
+            "rm_types": rm_types,
+            "nodes": rows,
+        }
+
+    def collapsed(self) -> list[str]:
+        """Flamegraph collapsed stacks (µs, all samples): skeleton;step;WT path segments;rmType."""
+        root = _frame(self.name)
+        lines = [f"{root};copy_and_group {self.copy_ns // 1000}"]
+        for wt_path, st in sorted(self.nodes.items()):
+            segs = ";".join(_frame(s) for s in wt_path.split("/"))
+            rm_type = _frame(st["rm_type"])
+            for step, ns in (
+                ("compile", st["compile_ns"]), ("mutate", st["mutate_ns"]),
+                ("null_flavour", st["null_flavour_ns"]), ("serialize", st["serialize_ns"]),
+            ):
+                us = int(ns // 1000)
+                if us:
+                    lines.append(f"{root};{step};{segs};{rm_type} {us}")
+        return lines
+
+
+def run_mutation_profile(
+    samples: int = _PLAN_SAMPLES, max_repeat: int = 0, top: int = 10
+) -> None:
+    """
+    Profile mutation and serialization per WT node for every skeleton
+    (see MutationProfile). Writes <skeleton>.json (nodes and rmTypes ranked
+    by time per composition) and <skeleton>.folded (flamegraph.pl /
+    speedscope input) to PROFILE_DIR and prints the top nodes.
+    """
+    flat_files = sorted(f for f in os.listdir(FLAT_DIR) if f.endswith(".json"))
+    if not flat_files:
+        print("[!] No example skeleton compositions are found; run Setup (mode 3) first.")
+        return
+
+    text_model()  # build/load once so the first handler compile excludes it
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    print(f"\n[*] Profiling mutation of {samples} composition(s) per skeleton ...")
+    for fname in flat_files:
+        try:
+            prof = MutationProfile(SkeletonGenerator(fname, max_repeat, validate=False))
+            for _ in range(samples):
+                prof.sample()
+            tracemalloc.start()
+            try:
+                for _ in range(min(samples, _PROFILE_TRACED)):
+                    prof.sample_traced()
+            finally:
+                tracemalloc.stop()
+        except Exception as e:
+            print(f"  [!] {fname}: {e}")
+            continue
+
+        report = prof.report()
+        base = os.path.join(PROFILE_DIR, prof.name)
+        with open(base + ".json", "w") as f:
+            json.dump(report, f, indent=2)
+        with open(base + ".folded", "w") as f:
+            f.write("\n".join(prof.collapsed()) + "\n")
+
+        pc = report["per_composition"]
+        print(
+            f"\n  {prof.name}: {report['keys_per_composition']:,.0f} keys, mutate {pc['mutate_ms']:.2f} ms, "
+            f"serialize {pc['serialize_pretty_ms']:.2f} ms file / {pc['serialize_compact_ms']:.2f} ms wire"
+        )
+        print(f"    {'rmType':<40} {'nodes':>6} {'µs/comp':>9} {'share':>7} {'alloc':>10}")
+        for agg in report["rm_types"][:top]:
+            print(
+                f"    {agg['rm_type'][:40]:<40} {agg['nodes']:>6,} {agg['total_us']:>9,.1f} "
+                f"{agg['share']:>7.1%} {_fmt_bytes(max(0.0, agg['alloc_bytes'])):>10}"
+            )
+        print(f"    {'WT path':<40} {'rmType':<14} {'µs/comp':>9} {'share':>7} {'alloc':>10}")
+        for r in report["nodes"][:top]:
+            print(
+                f"    {r['wt_path'][-40:]:<40} {r['rm_type'][:14]:<14} {r['total_us']:>9,.1f} "
+                f"{r['share']:>7.1%} {_fmt_bytes(max(0.0, r['alloc_bytes'])):>10}"
+            )
+    print(f"\n[*] Reports and collapsed stacks saved to {PROFILE_DIR}/")
+
+
+# ── mode 5: AQL query benchmark ────────────────────────────────────────────────
+
+# Attribute under a DV_* node's aqlPath that holds its comparable value
+_AQL_VALUE_ATTR = {
+    "DV_QUANTITY":   "/magnitude",
+    "DV_COUNT":      "/magnitude",
+    "DV_PROPORTION": "/numerator",
+    "DV_CODED_TEXT": "/defining_code/code_string",
+    "DV_ORDINAL":    "/value",
+    "DV_TEXT":       "/value",
+    "DV_BOOLEAN":    "/value",
+    "DV_DATE_TIME":  "/value",
+    "DV_DATE":       "/value",
+    "DV_TIME":       "/value",
+    "DV_DURATION":   "/value",
+    "DV_IDENTIFIER": "/id",
+}
+
+
+def _aql_literal(v) -> str:
+    if isinstance(v, str):
+        return "'" + v.replace("'", "\\'") + "'"
+    return repr(v)
+
+
+def derive_aql_queries(
+    template_id: str,
+    wt_index: dict[str, dict],
+    skeleton: Optional[dict] = None,
+    row_limit: int = _BENCH_ROW_LIMIT,
+) -> list[tuple[str, str]]:
+    """
+    Representative [(name, AQL)] for one template, per archetype:
+      proj   — c/uid plus up to _BENCH_COLUMNS leaf values (from WT aqlPaths)
+      range  — DV_QUANTITY magnitude within ±5 % of the skeleton value,
+               or the middle half of the WT range
+      coded  — DV_CODED_TEXT code equal to the skeleton's (or first listed) code
+    Leaves are addressed relative to their innermost archetype, which is
+    bound with CONTAINS; every query is restricted to the template.
+    """
+    root = wt_index.get(template_id) or next(iter(wt_index.values()), {})
+    comp_arch = root.get("nodeId", "")
+    skeleton_values: dict[tuple[str, str], object] = {}
+    for key, value in (skeleton or {}).items():
+        base, _, suffix = key.partition("|")
+        skeleton_values.setdefault((wt_path_of(base), suffix), value)
+
+    # Archetype roots (innermost first when walking up) and their leaves
+    archetypes = {
+        path: node for path, node in wt_index.items()
+        if node.get("nodeId", "").startswith("openEHR-EHR-")
+        and node.get("rmType") != "COMPOSITION" and node.get("aqlPath")
+    }
+    leaves: dict[str, list[tuple[str, str, dict]]] = {}
+    for path, node in wt_index.items():
+        rm_type = node.get("rmType", "")
+        aql = node.get("aqlPath", "")
+        if rm_type not in _AQL_VALUE_ATTR or not aql or _is_protected(path) or aql.endswith("/null_flavour"):
+            continue
+        owner = path
+        while owner and owner not in archetypes:
+            owner = owner.rpartition("/")[0]
+        if not owner or not aql.startswith(archetypes[owner]["aqlPath"]):
+            continue
+        leaves.setdefault(owner, []).append((path, aql[len(archetypes[owner]["aqlPath"]):], node))
+
+    comp = f"COMPOSITION c[{comp_arch}]" if comp_arch else "COMPOSITION c"
+    where = f"c/archetype_details/template_id/value = {_aql_literal(template_id)}"
+    limit = f" LIMIT {row_limit}" if row_limit else ""
+    queries: list[tuple[str, str]] = []
+    seen: set[str] = set()
+    for owner, items in leaves.items():
+        arch = archetypes[owner]
+        arch_id = arch["nodeId"]
+        if arch_id in seen:
+            continue  # same archetype at another position — same query shape
+        seen.add(arch_id)
+        short = arch_id.split(".", 1)[-1]
+        frm = f"FROM EHR e CONTAINS {comp} CONTAINS {arch['rmType']} a[{arch_id}]"
+
+        cols = [f"a{rel}{_AQL_VALUE_ATTR[n['rmType']]}" for _, rel, n in items[:_BENCH_COLUMNS]]
+        queries.append((
+            f"{template_id}/{short}/proj",
+            f"SELECT c/uid/value, {', '.join(cols)} {frm} WHERE {where}{limit}",
+        ))
+
+        ranges = coded = 0
+        for path, rel, node in items:
+            rm_type = node["rmType"]
+            inputs = node.get("inputs") or []
+            if rm_type == "DV_QUANTITY" and ranges < _BENCH_PER_ARCHETYPE:
+                v = skeleton_values.get((path, "magnitude"))
+                if isinstance(v, (int, float)) and not isinstance(v, bool) and v:
+                    lo, hi = sorted((v * 0.95, v * 1.05))
+                else:
+                    mag = next((i for i in inputs if i.get("suffix") in (None, "", "magnitude")), None)
+                    rng = ((mag or {}).get("validation") or {}).get("range") or {}
+                    if rng.get("min") is None or rng.get("max") is None:
+                        continue
+                    span = rng["max"] - rng["min"]
+                    lo, hi = rng["min"] + span / 4, rng["max"] - span / 4
+                ranges += 1
+                attr = f"a{rel}/magnitude"
+                queries.append((
+                    f"{template_id}/{short}/range:{node['id']}",
+                    f"SELECT c/uid/value, {attr} {frm} WHERE {where} "
+                    f"AND {attr} >= {round(lo, 4)} AND {attr} <= {round(hi, 4)}{limit}",
+                ))
+            elif rm_type == "DV_CODED_TEXT" and coded < _BENCH_PER_ARCHETYPE:
+                code = skeleton_values.get((path, "code"))
+                if not isinstance(code, str):
+                    listed = next((i["list"] for i in inputs if i.get("suffix") == "code" and i.get("list")), None)
+                    if not listed:
+                        continue
+                    code = listed[0]["value"]
+                coded += 1
+                attr = f"a{rel}/defining_code/code_string"
+                queries.append((
+                    f"{template_id}/{short}/coded:{node['id']}",
+                    f"SELECT c/uid/value, {attr} {frm} WHERE {where} AND {attr} = {_aql_literal(code)}{limit}",
+                ))
+    return queries
+
+
+def _percentile(ordered: list[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def _timed_aql(session: aiohttp.ClientSession, url: str, query: str) -> tuple[float, int]:
+    t = time.perf_counter()
+    async with session.post(
+        f"{url}/query/aql",
+        json={"q": query},
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+    ) as r:
+        if r.status != 200:
+            raise RuntimeError(f"AQL {r.status}: {(await r.text())[:200]}")
+        rows = (await r.json(content_type=None)).get("rows") or []
+    return time.perf_counter() - t, len(rows)
+
+
+async def run_query_bench(
+    session: aiohttp.ClientSession,
+    url: str,
+    repeats: int = _BENCH_REPEATS,
+    warmup: int = _BENCH_WARMUP,
+    concurrency: int = 10,
+    row_limit: int = _BENCH_ROW_LIMIT,
+) -> None:
+    """
+    Benchmark AQL queries derived from the templates with skeletons. Each
+    query gets `warmup` untimed runs, then `repeats` timed runs with up to
+    `concurrency` in flight; latency percentiles and rows/sec are printed
+    and written with the query texts to BENCH_REPORT.
+    """
+    flat_files = sorted(f for f in os.listdir(FLAT_DIR) if f.endswith(".json"))
+    queries: list[tuple[str, str]] = []
+    for fname in flat_files:
+        try:
+            with open(os.path.join(FLAT_DIR, fname)) as f:
+                envelope = json.load(f)
+            template_id = envelope.get("template_id")
+            wt_index = load_wt_index(template_id) if template_id else None
+            if wt_index is None:
+                raise ValueError(f"No webtemplate found for {template_id}")
+            queries.extend(derive_aql_queries(template_id, wt_index, envelope.get("flat_comp"), row_limit))
+        except Exception as e:
+            print(f"  [!] {fname}: {e}")
+    if not queries:
+        print("[!] No queries could be derived; run Setup (mode 3) first.")
+        return
+
+    print(f"[*] Benchmarking {len(queries)} AQL quer{'y' if len(queries) == 1 else 'ies'} "
+          f"({warmup} warm-up + {repeats} timed runs each, concurrency {concurrency}) ...")
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(query: str, timings: list[tuple[float, int]], errors: list[str]) -> None:
+        async with sem:
+            try:
+                timings.append(await _timed_aql(session, url, query))
+            except Exception as e:
+                errors.append(str(e))
+
+    print(f"\n  {'query':<48} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'rows':>7} {'rows/s':>9}")
+    for name, query in queries:
+        warm: list[tuple[float, int]] = []
+        errors: list[str] = []
+        await asyncio.gather(*(one(query, warm, errors) for _ in range(warmup)))
+        timings: list[tuple[float, int]] = []
+        errors.clear()
+        t = time.perf_counter()
+        await asyncio.gather(*(one(query, timings, errors) for _ in range(repeats)))
+        wall = time.perf_counter() - t
+
+        row = {"name": name, "aql": query, "runs": len(timings), "errors": len(errors)}
+        if timings:
+            lat = sorted(s for s, _ in timings)
+            rows = sum(n for _, n in timings)
+            row.update({
+                "p50_ms": _percentile(lat, 50) * 1000, "p95_ms": _percentile(lat, 95) * 1000,
+                "p99_ms": _percentile(lat, 99) * 1000, "max_ms": lat[-1] * 1000,
+                "rows_per_run": rows / len(timings), "rows_per_s": rows / wall if wall else 0.0,
+            })
+            print(
+                f"  {name[-48:]:<48} {row['p50_ms']:>5.0f} ms {row['p95_ms']:>5.0f} ms "
+                f"{row['p99_ms']:>5.0f} ms {row['max_ms']:>5.0f} ms {row['rows_per_run']:>7.0f} "
+                f"{row['rows_per_s']:>9,.0f}"
+            )
+        else:
+            print(f"  {name[-48:]:<48} {'failed':>8}")
+        if errors:
+            row["first_error"] = errors[0]
+            print(f"    [!] {len(errors)}/{repeats} failed: {errors[0]}")
+        results.append(row)
+
+    report = {
+        "url": url,
+        "run_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "warmup": warmup, "repeats": repeats, "concurrency": concurrency, "row_limit": row_limit,
+        "queries": results,
+    }
+    os.makedirs(os.path.dirname(BENCH_REPORT), exist_ok=True)
+    with open(BENCH_REPORT, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n[*] Report saved to {BENCH_REPORT}")
+
+
+def prompt_query_bench() -> tuple[int, int, int, int]:
+    """(repeats, warmup, concurrency, row_limit) with defaults."""
+    def ask(prompt: str, default: int, minimum: int = 1) -> int:
+        raw = input(f"  {prompt} [{default}]: ").strip()
+        return int(raw) if raw.isdigit() and int(raw) >= minimum else default
+    repeats = ask("Timed runs per query", _BENCH_REPEATS)
+    warmup = ask("Warm-up runs per query", _BENCH_WARMUP, 0)
+    concurrency = ask("Concurrent queries", 10)
+    row_limit = ask("Row LIMIT per query (0 = none)", _BENCH_ROW_LIMIT, 0)
+    return repeats, warmup, concurrency, row_limit
+
+
 # ── entry point ────────────────────────────────────────────────────────────────
 
 def prompt_api() -> tuple[str, aiohttp.BasicAuth]:
@@ -916,6 +3827,98 @@ def prompt_api() -> tuple[str, aiohttp.BasicAuth]:
     return url, aiohttp.BasicAuth(user, pwd)
 
 
+def prompt_layout() -> tuple[str, int]:
+    """Prompt for the individual-file directory layout and fan-out."""
+    raw = input("  Layout: (a) Flat / (b) Hashed subdirectories [default] / (c) Per-template: ").strip().lower()
+    layout = {"a": "flat", "c": "template"}.get(raw, "hash")
+    if layout == "flat":
+        return layout, 1
+    fan_raw = input(f"  Subdirectories per level [{_FANOUT}]: ").strip()
+    fanout = int(fan_raw) if fan_raw.isdigit() and int(fan_raw) > 0 else _FANOUT
+    return layout, fanout
+
+
+def prompt_counts(flat_files: list[str]) -> tuple[int, Optional[dict[str, int]]]:
+    """(count, targets): the workload mix when workload.json exists and is accepted, else count per skeleton."""
+    workload = load_workload()
+    if workload is not None and input(
+        f"Use the workload mix in {WORKLOAD_FILE}? [Y/n]: "
+    ).strip().lower() != "n":
+        count = int(input(f"Skeletons found: {len(flat_files)}. Total compositions [1000]: ").strip() or "1000")
+        targets = plan_workload(workload, flat_files, count)
+        for fname, n in sorted(targets.items(), key=lambda kv: -kv[1]):
+            print(f"  {n:>10,}  {fname[:-5]}")
+        return count, targets
+    count = int(
+        input(f"Skeletons found: {len(flat_files)}. Count per skeleton [1]: ").strip() or "1"
+    )
+    return count, None
+
+
+def prompt_ehr_distribution() -> Optional[tuple]:
+    """Prompt for the per-EHR composition count distribution; None = random pool."""
+    raw = input(
+        "  Compositions per EHR: (a) Random pool [default] / (b) Fixed / (c) Uniform range / (d) Long-tail: "
+    ).strip().lower()
+    if raw == "b":
+        n = input("    Compositions per EHR [100]: ").strip()
+        return ("fixed", int(n) if n.isdigit() and int(n) > 0 else 100)
+    if raw == "c":
+        lo = input("    Minimum per EHR [1]: ").strip()
+        hi = input("    Maximum per EHR [200]: ").strip()
+        lo_n = int(lo) if lo.isdigit() and int(lo) > 0 else 1
+        return ("range", lo_n, max(lo_n, int(hi) if hi.isdigit() else 200))
+    if raw == "d":
+        m = input("    Median per EHR [20]: ").strip()
+        return ("longtail", int(m) if m.isdigit() and int(m) > 0 else 20)
+    return None
+
+
+def prompt_timelines() -> Optional[Timelines]:
+    """Prompt for longitudinal per-EHR timelines; None = independent compositions."""
+    if input("  Longitudinal per-EHR timelines (dates follow each EHR's series)? [y/N]: ").strip().lower() != "y":
+        return None
+
+    def num(prompt: str, default: float) -> float:
+        raw = input(f"    {prompt} [{default:g}]: ").strip()
+        try:
+            return max(0.0, float(raw)) if raw else default
+        except ValueError:
+            return default
+    raw = input("    First compositions fall from (YYYY-MM-DD) [2020-01-01]: ").strip()
+    try:
+        start = dt.date.fromisoformat(raw) if raw else dt.date(2020, 1, 1)
+    except ValueError:
+        start = dt.date(2020, 1, 1)
+    span = int(num("... over a window of days", 365))
+    cadence = num("Mean days between an EHR's compositions", 7)
+    gap_prob = num("Chance of a gap after a composition, %", 5) / 100
+    gap_days = num("Mean gap length in days", 90)
+    trend = input("    Trend DV_QUANTITY values across each EHR's series? [y/N]: ").strip().lower() == "y"
+    return Timelines(start, span, cadence, gap_prob, gap_days, trend)
+
+
+async def make_ehr_pool(
+    session: Optional[aiohttp.ClientSession],
+    url: str,
+    total: int,
+    spec: Optional[tuple],
+    run_length: int = _EHR_RUN,
+) -> tuple[list[str], Optional[EhrScheduler]]:
+    """
+    EHR pool for a run: total // 100 random-choice EHRs, or one EHR per planned
+    quota. Without a session the pool is virtual patient ids (local series).
+    """
+    quotas = plan_ehr_quotas(total, spec) if spec else []
+    pool_size = len(quotas) if spec else max(1, total // 100)
+    if session is None:
+        ehr_pool = [f"patient{i:06d}" for i in range(pool_size)]
+    else:
+        print(f"\n[*] Creating {pool_size} EHR(s) ...")
+        ehr_pool = await create_ehr_pool(session, url, pool_size)
+    return ehr_pool, EhrScheduler(ehr_pool, quotas, run_length) if spec else None
+
+
 def load_api() -> Optional[tuple[str, aiohttp.BasicAuth]]:
     """Load saved API credentials silently. Returns None if config missing."""
     if not os.path.exists(CONFIG_FILE):
@@ -931,6 +3934,8 @@ async def main() -> None:
     print("1. Generate compositions from existing compositions (duplicate)")
     print("2. Generate compositions from templates and jitter")
     print("3. Setup: upload opts and set up modelling environment")
+    print("4. Plan: project time, disk and memory of a Mode 2 run (dry run)")
+    print("5. Benchmark: time AQL queries derived from the templates against the CDR")
     mode = input("Select mode: ").strip()
 
     start = time.monotonic()
@@ -938,8 +3943,8 @@ async def main() -> None:
         if mode == "3":
             url, auth = prompt_api()
             async with aiohttp.ClientSession(auth=auth) as session:
-                await upload_opts(session, url)
-                await run_setup(session, url)
+                manifest, pending, invalid, conflicts = await upload_opts(session, url)
+                await run_setup(session, url, manifest, pending, invalid, conflicts)
             return
 
         if mode == "1":
@@ -953,24 +3958,41 @@ async def main() -> None:
             print("  (a) Save to local disk (dist/compositions/)")
             print("  (b) Send to openEHR CDR")
             dest = input("  Destination [a/b]: ").strip().lower()
+            vary = input(
+                "  Vary values in each copy (quantities, counts, local codes, ordinals, dates)? [y/N]: "
+            ).strip().lower() == "y"
             packaging = "a"
+            layout, fanout = "flat", 1
             if dest == "a":
                 total = count * len(comp_files)
                 if total > 10000:
                     pkg = input(f"  {total:,} compositions to save: (a) Individual files / (b) tar.gz [default]:").strip().lower()
                     packaging = "a" if pkg == "a" else "b"
+                    if packaging == "a":
+                        layout, fanout = prompt_layout()
             if dest == "b":
                 api = load_api()
                 if not api:
                     return
                 url, auth = api
+                batch_raw = input(f"  Compositions per contribution (1 = one POST each) [{_CONTRIBUTION_BATCH}]: ").strip()
+                batch_size = int(batch_raw) if batch_raw.isdigit() and int(batch_raw) > 0 else _CONTRIBUTION_BATCH
+                fetch = input(
+                    "  Save the CDR's canonical copies to dist/compositions/ (fetched via AQL)? [y/N]: "
+                ).strip().lower() == "y"
+                spec = prompt_ehr_distribution()
                 async with aiohttp.ClientSession(auth=auth) as session:
-                    pool_size = max(1, (count * len(comp_files)) // 100)
-                    print(f"\n[*] Creating {pool_size} EHR(s) ...")
-                    ehr_pool = await create_ehr_pool(session, url, pool_size)
-                    await run_duplicate(dest, count, session, url, ehr_pool, packaging)
+                    # One run per EHR lease = one contribution
+                    ehr_pool, scheduler = await make_ehr_pool(
+                        session, url, count * len(comp_files), spec, batch_size
+                    )
+                    await run_duplicate(
+                        dest, count, session, url, ehr_pool, packaging, batch_size,
+                        RequestEncoder.for_url(url), scheduler=scheduler, vary=vary,
+                        fetch_canonical=fetch,
+                    )
             else:
-                await run_duplicate(dest, count, packaging=packaging)
+                await run_duplicate(dest, count, packaging=packaging, layout=layout, fanout=fanout, vary=vary)
             return
 
         if mode == "2":
@@ -978,34 +4000,102 @@ async def main() -> None:
             if not flat_files:
                 print("[!] No example skeleton compositions are found; run Setup (mode 3) first.")
                 return
-            count = int(
-                input(f"Skeletons found: {len(flat_files)}. Count per skeleton [1]: ").strip() or "1"
-            )
+            count, targets = prompt_counts(flat_files)
+            total = sum(targets.values()) if targets is not None else count * len(flat_files)
             print("  (a) Save to local disk (dist/compositions/)")
             print("  (b) Send to openEHR CDR")
             dest = input("  Destination [a/b]: ").strip().lower()
+            rep_raw = input("  Max instances per repeating node, e.g. events (0 = as in skeleton) [0]: ").strip()
+            max_repeat = int(rep_raw) if rep_raw.isdigit() else 0
+            unique = input("  Guarantee unique compositions (regenerate duplicates)? [y/N]: ").strip().lower() == "y"
+            timelines = prompt_timelines()
             fmt = "a"
             packaging = "a"
+            layout, fanout = "flat", 1
             if dest == "a":
                 fmt_raw = input("  Format: (a) Flat [default] / (b) Canonical (via AQL-note this requires POST to CDR): ").strip().lower()
                 fmt = fmt_raw if fmt_raw in ("a", "b") else "a"
-                total = count * len(flat_files)
                 if total > 10000:
                     pkg = input(f"  {total:,} compositions to save: (a) Individual files / (b) tar.gz [default]:").strip().lower()
                     packaging = "a" if pkg == "a" else "b"
+                    if packaging == "a":
+                        layout, fanout = prompt_layout()
             needs_cdr = dest == "b" or fmt == "b"
             if needs_cdr:
+                api = load_api()
+                if not api:
+                    return
+                url, auth = api
+                spec = prompt_ehr_distribution()
+                bench = None
+                if dest == "b" and input("  Benchmark AQL queries after loading? [y/N]: ").strip().lower() == "y":
+                    bench = prompt_query_bench()
+                async with aiohttp.ClientSession(auth=auth) as session:
+                    ehr_pool, scheduler = await make_ehr_pool(
+                        session, url, total, spec
+                    )
+                    await run_generate(
+                        dest, count, session, url, ehr_pool, fmt, packaging,
+                        RequestEncoder.for_url(url), layout, fanout, max_repeat,
+                        unique=unique, scheduler=scheduler, timelines=timelines, targets=targets,
+                    )
+                    if bench:
+                        print()
+                        await run_query_bench(session, url, *bench)
+            elif timelines:
+                # Local series: virtual patients stand in for EHRs
+                ehr_pool, scheduler = await make_ehr_pool(
+                    None, "", total, prompt_ehr_distribution()
+                )
+                await run_generate(
+                    dest, count, ehr_pool=ehr_pool, packaging=packaging, layout=layout,
+                    fanout=fanout, max_repeat=max_repeat, unique=unique,
+                    scheduler=scheduler, timelines=timelines, targets=targets,
+                )
+            else:
+                await run_generate(
+                    dest, count, packaging=packaging, layout=layout, fanout=fanout,
+                    max_repeat=max_repeat, unique=unique, targets=targets,
+                )
+            return
+
+        if mode == "4":
+            flat_files = sorted(f for f in os.listdir(FLAT_DIR) if f.endswith(".json"))
+            if not flat_files:
+                print("[!] No example skeleton compositions are found; run Setup (mode 3) first.")
+                return
+            count, targets = prompt_counts(flat_files)
+            rep_raw = input("  Max instances per repeating node, e.g. events (0 = as in skeleton) [0]: ").strip()
+            max_repeat = int(rep_raw) if rep_raw.isdigit() else 0
+            unique = input("  Guarantee unique compositions (regenerate duplicates)? [y/N]: ").strip().lower() == "y"
+            ehr_spec = prompt_ehr_distribution()
+            probe = input(
+                f"  Probe the CDR with {_PLAN_PROBES} real POSTs per skeleton (stored in the CDR)? [y/N]: "
+            ).strip().lower() == "y"
+            profile = input(
+                f"  Profile mutation cost per WT node and rmType (writes {PROFILE_DIR}/)? [y/N]: "
+            ).strip().lower() == "y"
+            if probe:
                 api = load_api()
                 if not api:
                     return
                 url, auth = api
                 async with aiohttp.ClientSession(auth=auth) as session:
-                    pool_size = max(1, (count * len(flat_files)) // 100)
-                    print(f"\n[*] Creating {pool_size} EHR(s) ...")
-                    ehr_pool = await create_ehr_pool(session, url, pool_size)
-                    await run_generate(dest, count, session, url, ehr_pool, fmt, packaging)
+                    await run_plan(count, max_repeat, unique, session, url, targets=targets, ehr_spec=ehr_spec)
             else:
-                await run_generate(dest, count, packaging=packaging)
+                await run_plan(count, max_repeat, unique, targets=targets, ehr_spec=ehr_spec)
+            if profile:
+                run_mutation_profile(_PLAN_SAMPLES, max_repeat)
+            return
+
+        if mode == "5":
+            api = load_api()
+            if not api:
+                return
+            url, auth = api
+            repeats, warmup, concurrency, row_limit = prompt_query_bench()
+            async with aiohttp.ClientSession(auth=auth) as session:
+                await run_query_bench(session, url, repeats, warmup, concurrency, row_limit)
             return
 
         print("[!] Unknown mode.")